@@ -4,42 +4,98 @@
 #include <string>
 #include <map>
 #include <memory>
+#include <vector>
 
 // Forward declaration
-namespace lwt {
-  class LightweightGraph;
-}
+class DenseStack;
 
+// Reader for a pair of networks trained on even / odd event numbers.
+// Networks are shared between all instances reading the same file.
 class Net {
 
 public:
   enum class Fold {Even, Odd};
 
+  // Inputs and buffers for evaluating one event. After 'init' the network
+  // itself is not modified by the evaluation, so it can be shared by several
+  // threads that each use their own context.
+  class Context {
+
+  public:
+    Context();
+
+    // After a reset no variable is set. Evaluating an event with a
+    // variable that is not set throws std::runtime_error.
+    void reset();
+    void set_variable(size_t index, const double val);
+
+  private:
+    friend class Net;
+    friend class ParametricNet;
+
+    // Mass-independent part of the first layer of the current event
+    const double *precompute(const DenseStack &graph);
+
+    // Inputs of the current event without the parameter
+    std::vector<double> m_inputs;
+
+    // Which inputs were set since the last reset and how many are missing
+    std::vector<bool> m_is_set;
+    size_t m_n_unset;
+
+    // First layer of the current event and the network it was computed for
+    // (nullptr if it needs to be recomputed)
+    std::vector<double> m_first_layer;
+    const DenseStack *m_first_layer_graph;
+
+    std::vector<double> m_scratch;
+  };
+
   Net();
-  ~Net();
+  virtual ~Net();
 
   // Set the lwtnn network configuration
   // filename_even: Network trained on even event numbers
   // filename_odd: Network trained on odd event numbers
   void init(const std::string &filename_even,
             const std::string &filename_odd);
+
+  // Slot of a variable for 'set_variable(size_t, double)'. Resolve the slots
+  // once after 'init' to avoid the name lookup on every event.
+  size_t variable_index(const std::string &name) const;
+
+  // Input variables (without parameter) in the order of their slots
+  const std::vector<std::string> &variables() const;
+
+  // Context with buffers sized for this network (one per thread)
+  Context make_context() const;
+
+  // Single-threaded interface using a context owned by the reader
   void reset();
   void set_variable(const std::string &name, const double val);
+  void set_variable(size_t index, const double val);
   float evaluate(Fold fold);
 
-private:
-  using ValueMap = std::map<std::string, double>;
-  using NodeMap = std::map<std::string, ValueMap>;
+  // Thread-safe evaluation of the event in 'context'
+  float evaluate(Context &context, Fold fold) const;
+
+protected:
+  // parameter_name: Input of the network that is not set per event
+  explicit Net(const std::string &parameter_name);
+
+  const DenseStack &graph(Fold fold) const;
 
   const std::string m_input_layer_name;
   const std::string m_output_layer_name;
   const std::string m_output_node_name;
+  const std::string m_parameter_name;
+
+  std::shared_ptr<const DenseStack> m_graph_even;
+  std::shared_ptr<const DenseStack> m_graph_odd;
 
-  std::unique_ptr<const lwt::LightweightGraph> m_graph_even;
-  std::unique_ptr<const lwt::LightweightGraph> m_graph_odd;
+  std::map<std::string, size_t> m_variable_index;
 
-  NodeMap m_node_map;
-  ValueMap *m_val_map;
+  Context m_context;
 };
 
 #endif // NET_H_
@@ -2,46 +2,56 @@
 #define PARAMETRICNET_H_
 
 #include <string>
-#include <map>
-#include <memory>
+#include <vector>
 
-// Forward declaration
-namespace lwt {
-  class LightweightGraph;
-}
+#include "ParametricNet/Net.h"
 
-// TODO: This should derive from Net
-class ParametricNet {
+class ParametricNet : public Net {
 
 public:
-  enum class Fold {Even, Odd};
-
   ParametricNet();
   ~ParametricNet();
 
-  // Set the lwtnn network configuration
-  // filename_even: Network trained on even event numbers
-  // filename_odd: Network trained on odd event numbers
-  void init(const std::string &filename_even,
-            const std::string &filename_odd);
-  void reset();
-  void set_variable(const std::string &name, const double val);
   float evaluate(float parameter, Fold fold);
 
-private:
-  using ValueMap = std::map<std::string, double>;
-  using NodeMap = std::map<std::string, ValueMap>;
-
-  const std::string m_input_layer_name;
-  const std::string m_output_layer_name;
-  const std::string m_output_node_name;
-  const std::string m_parameter_name;
-
-  std::unique_ptr<const lwt::LightweightGraph> m_graph_even;
-  std::unique_ptr<const lwt::LightweightGraph> m_graph_odd;
-
-  NodeMap m_node_map;
-  ValueMap *m_val_map;
+  // Evaluate the current event at several parameters
+  // scores: Resized to the number of parameters, same order as 'parameters'
+  void evaluate(const std::vector<float> &parameters, Fold fold,
+                std::vector<float> &scores);
+
+  // Evaluate a block of events at several parameters
+  // inputs: Row-major n_events x n_variables with the variables in the
+  //         order of 'variables()' (i.e. by slot)
+  // folds: Fold of every event
+  // scores: Row-major n_events x n_parameters
+  void evaluate(const std::vector<double> &inputs,
+                const std::vector<Fold> &folds,
+                const std::vector<float> &parameters,
+                std::vector<float> &scores);
+
+  // Evaluate rows of variables and parameter (e.g. event and mass pairs)
+  // rows: Row-major n_rows x (n_variables + 1) with the variables in the order
+  //       of 'variables()' followed by the parameter
+  // folds: Fold of every row
+  // scores: One score per row
+  void evaluate_rows(const std::vector<double> &rows,
+                     const std::vector<Fold> &folds,
+                     std::vector<float> &scores);
+
+  // Thread-safe versions of the above evaluating the event in 'context'
+  // (the block and row evaluation only use its buffers)
+  float evaluate(Context &context, float parameter, Fold fold) const;
+  void evaluate(Context &context, const std::vector<float> &parameters, Fold fold,
+                std::vector<float> &scores) const;
+  void evaluate(Context &context,
+                const std::vector<double> &inputs,
+                const std::vector<Fold> &folds,
+                const std::vector<float> &parameters,
+                std::vector<float> &scores) const;
+  void evaluate_rows(Context &context,
+                     const std::vector<double> &rows,
+                     const std::vector<Fold> &folds,
+                     std::vector<float> &scores) const;
 };
 
 #endif // PARAMETRICNET_H_
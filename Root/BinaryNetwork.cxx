@@ -0,0 +1,139 @@
+#include "BinaryNetwork.h"
+
+#include <algorithm>
+#include <cstdint>
+#include <cstring>
+#include <fstream>
+#include <iterator>
+#include <stdexcept>
+#include <vector>
+
+#include "DenseStack.h"
+
+
+namespace {
+
+  const char magic[8] = {'P', 'N', 'E', 'T', 'B', 'I', 'N', '\0'};
+  const uint32_t format_version = 1;
+
+  // Sequential reader over the content of the file
+  class Reader {
+
+  public:
+    Reader(const std::vector<char> &buffer, const std::string &filename) :
+      m_buffer(buffer), m_filename(filename), m_pos(0) {
+    }
+
+    void read(void *out, size_t n_bytes) {
+      if (m_pos + n_bytes > m_buffer.size()) {
+        throw std::runtime_error("BinaryNetwork: unexpected end of " + m_filename);
+      }
+      std::memcpy(out, m_buffer.data() + m_pos, n_bytes);
+      m_pos += n_bytes;
+    }
+
+    uint32_t read_uint32() {
+      uint32_t value;
+      read(&value, sizeof(value));
+      return value;
+    }
+
+    double read_double() {
+      double value;
+      read(&value, sizeof(value));
+      return value;
+    }
+
+    std::vector<double> read_doubles(size_t n) {
+      std::vector<double> values(n);
+      read(values.data(), n * sizeof(double));
+      return values;
+    }
+
+    std::string read_string() {
+      std::string value(read_uint32(), '\0');
+      read(&value[0], value.size());
+      return value;
+    }
+
+    void align(size_t n_bytes) {
+      m_pos = (m_pos + n_bytes - 1) / n_bytes * n_bytes;
+    }
+
+  private:
+    const std::vector<char> &m_buffer;
+    const std::string &m_filename;
+    size_t m_pos;
+  };
+
+}
+
+
+bool is_binary_network(const std::string &filename) {
+  std::ifstream input_file(filename, std::ios::binary);
+  char header[sizeof(magic)] = {};
+  input_file.read(header, sizeof(header));
+  return input_file && std::equal(header, header + sizeof(header), magic);
+}
+
+std::shared_ptr<const DenseStack> read_binary_network(const std::string &filename,
+                                                      const std::string &output_node,
+                                                      const std::string &parameter_name) {
+  std::ifstream input_file(filename, std::ios::binary);
+  if (!input_file) {
+    throw std::runtime_error("BinaryNetwork: cannot open " + filename);
+  }
+  const std::vector<char> buffer((std::istreambuf_iterator<char>(input_file)),
+                                 std::istreambuf_iterator<char>());
+  Reader reader(buffer, filename);
+
+  char header[sizeof(magic)];
+  reader.read(header, sizeof(header));
+  if (!std::equal(header, header + sizeof(header), magic)) {
+    throw std::runtime_error("BinaryNetwork: " + filename + " is not a binary network");
+  }
+  if (reader.read_uint32() != format_version) {
+    throw std::runtime_error("BinaryNetwork: unsupported format version in " + filename);
+  }
+
+  std::vector<DenseStack::Variable> variables(reader.read_uint32());
+  for (auto &var : variables) {
+    var.name = reader.read_string();
+  }
+
+  std::vector<std::string> labels(reader.read_uint32());
+  for (auto &label : labels) {
+    label = reader.read_string();
+  }
+  const auto label = std::find(labels.begin(), labels.end(), output_node);
+  if (label == labels.end()) {
+    throw std::runtime_error("BinaryNetwork: no output node " + output_node + " in " + filename);
+  }
+
+  std::vector<DenseStack::Layer> layers(reader.read_uint32());
+  reader.align(8);
+
+  for (auto &var : variables) {
+    var.offset = reader.read_double();
+  }
+  for (auto &var : variables) {
+    var.scale = reader.read_double();
+  }
+
+  for (auto &layer : layers) {
+    layer.n_inputs = reader.read_uint32();
+    layer.n_outputs = reader.read_uint32();
+    const uint32_t activation = reader.read_uint32();
+    if (activation > static_cast<uint32_t>(DenseStack::Activation::Elu)) {
+      throw std::runtime_error("BinaryNetwork: unknown activation in " + filename);
+    }
+    layer.activation = static_cast<DenseStack::Activation>(activation);
+    reader.read_uint32();
+    layer.alpha = reader.read_double();
+    layer.weights = reader.read_doubles(layer.n_outputs * layer.n_inputs);
+    layer.bias = reader.read_doubles(layer.n_outputs);
+  }
+
+  return std::make_shared<const DenseStack>(variables, layers, parameter_name,
+                                            label - labels.begin());
+}
@@ -0,0 +1,32 @@
+#ifndef BINARYNETWORK_H_
+#define BINARYNETWORK_H_
+
+#include <memory>
+#include <string>
+
+class DenseStack;
+
+// Networks in the binary format written by 'scripts/compile_net.py'
+// (all values little-endian, arrays aligned to 8 bytes):
+//
+//   char[8]    magic "PNETBIN\0"
+//   uint32     format version
+//   uint32     number of input variables, followed by their names
+//   uint32     number of output labels, followed by the labels
+//   uint32     number of layers
+//   (padding to a multiple of 8 bytes)
+//   float64[]  input offsets and scales (lwtnn convention)
+//   per layer: uint32 n_inputs, uint32 n_outputs, uint32 activation,
+//              uint32 (unused), float64 alpha,
+//              float64[n_outputs x n_inputs] weights (row-major),
+//              float64[n_outputs] bias
+//
+// Names are stored as uint32 length followed by the characters.
+
+bool is_binary_network(const std::string &filename);
+
+std::shared_ptr<const DenseStack> read_binary_network(const std::string &filename,
+                                                      const std::string &output_node,
+                                                      const std::string &parameter_name);
+
+#endif // BINARYNETWORK_H_
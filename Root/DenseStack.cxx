@@ -0,0 +1,285 @@
+#include "DenseStack.h"
+
+#include <algorithm>
+#include <cmath>
+#include <stdexcept>
+
+#include <Eigen/Dense>
+
+#include "lwtnn/NNLayerConfig.hh"
+
+
+namespace {
+
+  DenseStack::Activation convert_activation(lwt::Activation activation) {
+    using Activation = DenseStack::Activation;
+    switch (activation) {
+    case lwt::Activation::LINEAR: return Activation::Linear;
+    case lwt::Activation::SIGMOID: return Activation::Sigmoid;
+    case lwt::Activation::RECTIFIED: return Activation::Rectified;
+    case lwt::Activation::TANH: return Activation::Tanh;
+    case lwt::Activation::HARD_SIGMOID: return Activation::HardSigmoid;
+    case lwt::Activation::ELU: return Activation::Elu;
+    default:
+      throw std::runtime_error("DenseStack: unsupported activation function");
+    }
+  }
+
+  // Same definitions as in lwtnn. NaN inputs propagate to the output, so
+  // that an unset variable does not give an ordinary-looking score.
+  void activate(DenseStack::Activation activation, double alpha,
+                double *values, size_t n) {
+    using Activation = DenseStack::Activation;
+    switch (activation) {
+    case Activation::Linear:
+      break;
+    case Activation::Sigmoid:
+      for (size_t i = 0; i < n; ++i) {
+        const double x = values[i];
+        values[i] = x < -30 ? 0.0 : (x > 30 ? 1.0 : 1.0 / (1.0 + std::exp(-x)));
+      }
+      break;
+    case Activation::Rectified:
+      for (size_t i = 0; i < n; ++i) {
+        values[i] = values[i] < 0 ? 0.0 : values[i];
+      }
+      break;
+    case Activation::Tanh:
+      for (size_t i = 0; i < n; ++i) {
+        values[i] = std::tanh(values[i]);
+      }
+      break;
+    case Activation::HardSigmoid:
+      for (size_t i = 0; i < n; ++i) {
+        values[i] = std::min(std::max(0.2 * values[i] + 0.5, 0.0), 1.0);
+      }
+      break;
+    case Activation::Elu:
+      for (size_t i = 0; i < n; ++i) {
+        const double x = values[i];
+        values[i] = x > 0 ? x : alpha * (std::exp(x) - 1.0);
+      }
+      break;
+    }
+  }
+
+}
+
+
+const size_t DenseStack::batch_size;
+
+DenseStack::DenseStack(const lwt::GraphConfig &config,
+                       const std::string &parameter_name,
+                       const std::string &output_name,
+                       size_t output_index) :
+  m_output_index(output_index) {
+  // Walk from the output node back to the input node
+  using Type = lwt::NodeConfig::Type;
+  std::vector<const lwt::LayerConfig*> layers;
+  const lwt::NodeConfig *node = &config.nodes.at(config.outputs.at(output_name).node_index);
+  while (node->type == Type::FEED_FORWARD) {
+    const auto &layer = config.layers.at(node->index);
+    if (layer.architecture != lwt::Architecture::DENSE) {
+      throw std::runtime_error("DenseStack: only dense layers are supported");
+    }
+    layers.push_back(&layer);
+    node = &config.nodes.at(node->sources.at(0));
+  }
+  if (node->type != Type::INPUT || layers.empty()) {
+    throw std::runtime_error("DenseStack: graph is not a chain of dense layers");
+  }
+  std::reverse(layers.begin(), layers.end());
+
+  std::vector<Variable> variables;
+  for (const auto &var : config.inputs.at(node->sources.at(0)).variables) {
+    variables.push_back({var.name, var.offset, var.scale});
+  }
+
+  std::vector<Layer> dense_layers;
+  for (const auto *config_layer : layers) {
+    Layer layer;
+    layer.n_outputs = config_layer->bias.size();
+    layer.n_inputs = config_layer->weights.size() / layer.n_outputs;
+    layer.weights = config_layer->weights;
+    layer.bias = config_layer->bias;
+    layer.activation = convert_activation(config_layer->activation.function);
+    layer.alpha = config_layer->activation.alpha;
+    dense_layers.push_back(layer);
+  }
+
+  setup(variables, dense_layers, parameter_name);
+}
+
+DenseStack::DenseStack(const std::vector<Variable> &variables,
+                       const std::vector<Layer> &layers,
+                       const std::string &parameter_name,
+                       size_t output_index) :
+  m_output_index(output_index) {
+  setup(variables, layers, parameter_name);
+}
+
+void DenseStack::setup(const std::vector<Variable> &variables,
+                       const std::vector<Layer> &layers,
+                       const std::string &parameter_name) {
+  if (layers.empty()) {
+    throw std::runtime_error("DenseStack: network has no layers");
+  }
+
+  // Inputs in the order of the network with the parameter moved to the end
+  std::vector<size_t> columns;
+  size_t parameter_column = 0;
+  bool found_parameter = false;
+  for (size_t col = 0; col < variables.size(); ++col) {
+    if (!parameter_name.empty() && variables[col].name == parameter_name) {
+      parameter_column = col;
+      found_parameter = true;
+    } else {
+      m_variables.push_back(variables[col].name);
+      columns.push_back(col);
+    }
+  }
+  if (!parameter_name.empty() && !found_parameter) {
+    throw std::runtime_error("DenseStack: network has no input " + parameter_name);
+  }
+  if (found_parameter) {
+    columns.push_back(parameter_column);
+  }
+  m_max_width = 0;
+  size_t n_inputs = variables.size();
+  for (const auto &layer : layers) {
+    if (layer.n_inputs != n_inputs || layer.weights.size() != layer.n_inputs * layer.n_outputs ||
+        layer.bias.size() != layer.n_outputs) {
+      throw std::runtime_error("DenseStack: inconsistent layer sizes");
+    }
+    n_inputs = layer.n_outputs;
+    m_max_width = std::max(m_max_width, layer.n_outputs);
+  }
+
+  // Column-major weights for the matrix products
+  for (const auto &layer : layers) {
+    Layer transposed(layer);
+    for (size_t row = 0; row < layer.n_outputs; ++row) {
+      for (size_t col = 0; col < layer.n_inputs; ++col) {
+        transposed.weights[col * layer.n_outputs + row] = layer.weights[row * layer.n_inputs + col];
+      }
+    }
+    m_layers.push_back(transposed);
+  }
+
+  // Fold the input scaling into the first layer and move the parameter
+  // column out: w * (x + offset) * scale = (w * scale) * x + w * offset * scale
+  Layer &first = m_layers.front();
+  const Layer &config_first = layers.front();
+  const size_t n_variables = m_variables.size();
+  first.n_inputs = n_variables;
+  first.weights.assign(n_variables * first.n_outputs, 0.0);
+  for (size_t row = 0; row < first.n_outputs; ++row) {
+    const double *config_row = &config_first.weights[row * config_first.n_inputs];
+    for (size_t i = 0; i < columns.size(); ++i) {
+      const auto &var = variables[columns[i]];
+      const double weight = config_row[columns[i]] * var.scale;
+      first.bias[row] += weight * var.offset;
+      if (i < n_variables) {
+        first.weights[i * first.n_outputs + row] = weight;
+      } else {
+        m_parameter_weights.push_back(weight);
+      }
+    }
+  }
+
+  if (m_output_index >= m_layers.back().n_outputs) {
+    throw std::runtime_error("DenseStack: output index out of range");
+  }
+}
+
+void DenseStack::precompute(const double *inputs, double *first_layer) const {
+  const Layer &first = m_layers.front();
+  std::copy(first.bias.begin(), first.bias.end(), first_layer);
+  for (size_t col = 0; col < first.n_inputs; ++col) {
+    const double x = inputs[col];
+    const double *w = &first.weights[col * first.n_outputs];
+    for (size_t row = 0; row < first.n_outputs; ++row) {
+      first_layer[row] += w[row] * x;
+    }
+  }
+}
+
+double DenseStack::evaluate(const double *first_layer, double parameter,
+                            double *scratch) const {
+  const size_t width = m_layers.front().n_outputs;
+  add_parameter(first_layer, parameter, scratch);
+  activate(m_layers.front().activation, m_layers.front().alpha, scratch, width);
+  return forward(scratch, 1, scratch + batch_size * m_max_width)[m_output_index];
+}
+
+void DenseStack::evaluate(const double *first_layer, const float *parameters,
+                          size_t n_parameters, float *scores, double *scratch) const {
+  const Layer &first = m_layers.front();
+  const size_t width = first.n_outputs;
+  for (size_t start = 0; start < n_parameters; start += batch_size) {
+    const size_t n_rows = std::min(batch_size, n_parameters - start);
+    for (size_t i = 0; i < n_rows; ++i) {
+      add_parameter(first_layer, parameters[start + i], scratch + i * width);
+    }
+    activate(first.activation, first.alpha, scratch, n_rows * width);
+
+    store(forward(scratch, n_rows, scratch + batch_size * m_max_width), n_rows, scores + start);
+  }
+}
+
+void DenseStack::evaluate_rows(const double *rows, size_t n_rows, float *scores,
+                               double *scratch) const {
+  const Layer &first = m_layers.front();
+  const size_t width = first.n_outputs;
+  const size_t row_size = first.n_inputs + (has_parameter() ? 1 : 0);
+  for (size_t start = 0; start < n_rows; start += batch_size) {
+    const size_t n_batch = std::min(batch_size, n_rows - start);
+    for (size_t i = 0; i < n_batch; ++i) {
+      const double *row = rows + (start + i) * row_size;
+      double *values = scratch + i * width;
+      precompute(row, values);
+      add_parameter(values, has_parameter() ? row[first.n_inputs] : 0.0, values);
+    }
+    activate(first.activation, first.alpha, scratch, n_batch * width);
+
+    store(forward(scratch, n_batch, scratch + batch_size * m_max_width), n_batch, scores + start);
+  }
+}
+
+void DenseStack::add_parameter(const double *first_layer, double parameter,
+                               double *values) const {
+  const size_t width = m_layers.front().n_outputs;
+  if (has_parameter()) {
+    for (size_t row = 0; row < width; ++row) {
+      values[row] = first_layer[row] + m_parameter_weights[row] * parameter;
+    }
+  } else if (values != first_layer) {
+    std::copy_n(first_layer, width, values);
+  }
+}
+
+const double *DenseStack::forward(double *values, size_t n_rows, double *scratch) const {
+  // Alternate between the two buffers, each holding one column per row of
+  // the batch
+  double *in = values;
+  double *out = scratch;
+  for (size_t i = 1; i < m_layers.size(); ++i) {
+    const Layer &layer = m_layers[i];
+    Eigen::Map<const Eigen::MatrixXd> weights(layer.weights.data(), layer.n_outputs, layer.n_inputs);
+    Eigen::Map<const Eigen::VectorXd> bias(layer.bias.data(), layer.n_outputs);
+    Eigen::Map<const Eigen::MatrixXd> x(in, layer.n_inputs, n_rows);
+    Eigen::Map<Eigen::MatrixXd> y(out, layer.n_outputs, n_rows);
+    y.noalias() = weights * x;
+    y.colwise() += bias;
+    activate(layer.activation, layer.alpha, out, n_rows * layer.n_outputs);
+    std::swap(in, out);
+  }
+  return in;
+}
+
+void DenseStack::store(const double *outputs, size_t n_rows, float *scores) const {
+  const size_t width = m_layers.back().n_outputs;
+  for (size_t r = 0; r < n_rows; ++r) {
+    scores[r] = outputs[r * width + m_output_index];
+  }
+}
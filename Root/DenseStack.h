@@ -0,0 +1,113 @@
+#ifndef DENSESTACK_H_
+#define DENSESTACK_H_
+
+#include <string>
+#include <vector>
+
+// Forward declaration
+namespace lwt {
+  struct GraphConfig;
+}
+
+// Chain of dense layers evaluated without the generic lwtnn graph. The input
+// scaling is folded into the first layer and every layer is stored as one
+// contiguous column-major matrix. Several rows (events or parameters) are
+// propagated through the layers together as matrix products.
+//
+// For parametrised networks the contribution of the parameter to the first
+// layer is kept separate so that the rest of the first layer can be computed
+// once per event and reused for every parameter.
+class DenseStack {
+
+public:
+  // Number of rows propagated through the layers together
+  static const size_t batch_size = 16;
+
+  // The values are used in the binary network format
+  enum class Activation {Linear = 0, Sigmoid = 1, Rectified = 2, Tanh = 3,
+                         HardSigmoid = 4, Elu = 5};
+
+  struct Variable {
+    std::string name;
+    double offset;
+    double scale;
+  };
+
+  struct Layer {
+    size_t n_inputs;
+    size_t n_outputs;
+    std::vector<double> weights; // Row-major n_outputs x n_inputs
+    std::vector<double> bias;
+    Activation activation;
+    double alpha;
+  };
+
+  // Extract the layers leading to 'output_name' from an lwtnn graph
+  // parameter_name: Input treated as parameter (empty if there is none)
+  // Throws std::runtime_error if the graph is not a plain dense stack.
+  DenseStack(const lwt::GraphConfig &config,
+             const std::string &parameter_name,
+             const std::string &output_name,
+             size_t output_index);
+
+  // Network from its inputs and layers
+  // variables: Inputs in the order of the columns of the first layer
+  DenseStack(const std::vector<Variable> &variables,
+             const std::vector<Layer> &layers,
+             const std::string &parameter_name,
+             size_t output_index);
+
+  // Input variables without the parameter in the order expected by 'precompute'
+  const std::vector<std::string> &variables() const { return m_variables; }
+  bool has_parameter() const { return !m_parameter_weights.empty(); }
+
+  // Size of the buffers passed to the functions below
+  size_t first_layer_size() const { return m_layers.front().n_outputs; }
+  size_t scratch_size() const { return 2 * batch_size * m_max_width; }
+
+  // Pre-activation of the first layer from all inputs but the parameter
+  void precompute(const double *inputs, double *first_layer) const;
+
+  // Output for one parameter given the precomputed first layer (the parameter
+  // is ignored for networks without parameter)
+  double evaluate(const double *first_layer, double parameter,
+                  double *scratch) const;
+
+  // Outputs for several parameters given the precomputed first layer
+  void evaluate(const double *first_layer, const float *parameters,
+                size_t n_parameters, float *scores, double *scratch) const;
+
+  // Outputs for rows of inputs in the order of 'variables()' followed by the
+  // parameter (if the network has one)
+  void evaluate_rows(const double *rows, size_t n_rows, float *scores,
+                     double *scratch) const;
+
+private:
+  void setup(const std::vector<Variable> &variables,
+             const std::vector<Layer> &layers,
+             const std::string &parameter_name);
+
+  // First layer pre-activation including the parameter
+  void add_parameter(const double *first_layer, double parameter,
+                     double *values) const;
+
+  // Layers after the first one for 'n_rows' rows, returns the buffer holding
+  // the outputs
+  const double *forward(double *values, size_t n_rows, double *scratch) const;
+
+  void store(const double *outputs, size_t n_rows, float *scores) const;
+
+  std::vector<std::string> m_variables;
+
+  // Column of the parameter in the first layer including its scale (empty if
+  // there is none)
+  std::vector<double> m_parameter_weights;
+
+  // Weights in column-major order (i.e. transposed with respect to 'Layer'),
+  // the first layer without the parameter and with the input scaling applied
+  std::vector<Layer> m_layers;
+  size_t m_output_index;
+  size_t m_max_width;
+};
+
+#endif // DENSESTACK_H_
@@ -0,0 +1,127 @@
+#include "GraphRegistry.h"
+
+#include <algorithm>
+#include <cmath>
+#include <fstream>
+#include <limits>
+#include <map>
+#include <mutex>
+#include <stdexcept>
+#include <tuple>
+#include <vector>
+
+#include "lwtnn/LightweightGraph.hh"
+#include "lwtnn/parse_json.hh"
+
+#include "BinaryNetwork.h"
+#include "DenseStack.h"
+
+
+namespace {
+
+  using Key = std::tuple<std::string, std::string, std::string, std::string, std::string>;
+
+  std::mutex registry_mutex;
+  std::map<Key, std::weak_ptr<const DenseStack>> registry;
+
+  // Compare the dense evaluation to lwtnn for a few inputs
+  void validate(const lwt::GraphConfig &config, const DenseStack &dense,
+                const GraphNames &names) {
+    const lwt::LightweightGraph graph(config, names.output_layer);
+    const auto &variables = config.inputs.at(0).variables;
+
+    // Unscaled input value for a given scaled value
+    const auto unscale = [&variables](const std::string &name, double scaled) {
+      const auto var = std::find_if(variables.begin(), variables.end(),
+                                    [&name](const lwt::Input &v) { return v.name == name; });
+      return scaled / var->scale - var->offset;
+    };
+
+    std::vector<double> first_layer(dense.first_layer_size());
+    std::vector<double> scratch(dense.scratch_size());
+    for (const double scaled : {-1.0, 0.0, 0.5}) {
+      // Different scaled value for every input, so that swapped columns are noticed
+      lwt::NodeMap nodes;
+      std::vector<double> inputs;
+      for (const auto &name : dense.variables()) {
+        inputs.push_back(unscale(name, scaled + 0.37 * inputs.size()));
+        nodes[names.input_layer][name] = inputs.back();
+      }
+      dense.precompute(inputs.data(), first_layer.data());
+
+      // Several parameter values for the same event test the parameter column
+      // apart from the cached first layer
+      for (const double scaled_parameter : {-0.8, 0.3, 1.1}) {
+        double parameter = 0.0;
+        if (dense.has_parameter()) {
+          parameter = unscale(names.parameter, scaled_parameter);
+          nodes[names.input_layer][names.parameter] = parameter;
+        }
+
+        const double expected = graph.compute(nodes).at(names.output_node);
+        const double result = dense.evaluate(first_layer.data(), parameter, scratch.data());
+        if (std::abs(result - expected) > 1e-5) {
+          throw std::runtime_error("GraphRegistry: dense evaluation of " +
+                                   names.output_layer + " does not match lwtnn");
+        }
+      }
+    }
+
+    // A missing input must not give a valid score
+    if (!dense.variables().empty()) {
+      std::vector<double> inputs(dense.variables().size(), 0.0);
+      inputs.front() = std::numeric_limits<double>::quiet_NaN();
+      dense.precompute(inputs.data(), first_layer.data());
+      if (!std::isnan(dense.evaluate(first_layer.data(), 0.0, scratch.data()))) {
+        throw std::runtime_error("GraphRegistry: dense evaluation of " +
+                                 names.output_layer + " hides a missing input");
+      }
+    }
+  }
+
+  std::shared_ptr<const DenseStack> parse_graph(const std::string &filename,
+                                                const GraphNames &names) {
+    // Binary networks are not compared to lwtnn here. compile_net.py checks
+    // that the file reproduces its JSON network, and pnet_benchmark_formats
+    // compares the scores read by this loader to those of the JSON version.
+    if (is_binary_network(filename)) {
+      return read_binary_network(filename, names.output_node, names.parameter);
+    }
+
+    std::ifstream input_file(filename);
+    if (!input_file) {
+      throw std::runtime_error("GraphRegistry: cannot open " + filename);
+    }
+    const lwt::GraphConfig config = lwt::parse_json_graph(input_file);
+
+    const auto &labels = config.outputs.at(names.output_layer).labels;
+    const auto label = std::find(labels.begin(), labels.end(), names.output_node);
+    if (label == labels.end()) {
+      throw std::runtime_error("GraphRegistry: no output node " + names.output_node +
+                               " in " + filename);
+    }
+
+    auto graph = std::make_shared<const DenseStack>(config, names.parameter, names.output_layer,
+                                                    label - labels.begin());
+    validate(config, *graph, names);
+    return graph;
+  }
+
+}
+
+
+std::shared_ptr<const DenseStack> load_graph(const std::string &filename,
+                                             const GraphNames &names) {
+  const Key key(filename, names.input_layer, names.output_layer,
+                names.output_node, names.parameter);
+
+  // Parsing happens under the lock so that concurrent readers of the same
+  // file wait for the first one instead of parsing it again
+  std::lock_guard<std::mutex> lock(registry_mutex);
+  auto graph = registry[key].lock();
+  if (!graph) {
+    graph = parse_graph(filename, names);
+    registry[key] = graph;
+  }
+  return graph;
+}
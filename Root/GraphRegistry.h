@@ -0,0 +1,24 @@
+#ifndef GRAPHREGISTRY_H_
+#define GRAPHREGISTRY_H_
+
+#include <memory>
+#include <string>
+
+class DenseStack;
+
+// Names identifying inputs and output of a network in the lwtnn configuration
+struct GraphNames {
+  std::string input_layer;
+  std::string output_layer;
+  std::string output_node;
+  std::string parameter; // Empty for networks without parameter
+};
+
+// Process-wide, thread-safe cache of the networks read from lwtnn JSON files
+// or their binary version (see BinaryNetwork.h).
+// Every file is parsed only once and shared by all readers for as long as
+// one of them holds it.
+std::shared_ptr<const DenseStack> load_graph(const std::string &filename,
+                                             const GraphNames &names);
+
+#endif // GRAPHREGISTRY_H_
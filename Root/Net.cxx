@@ -1,55 +1,134 @@
 #include "ParametricNet/Net.h"
 
-#include <fstream>
+#include <algorithm>
+#include <limits>
+#include <stdexcept>
 
-#include "lwtnn/LightweightGraph.hh"
-#include "lwtnn/parse_json.hh"
+#include "DenseStack.h"
+#include "GraphRegistry.h"
 
 
-Net::Net() :
+Net::Context::Context() :
+  m_n_unset(0),
+  m_first_layer_graph(nullptr) {
+}
+
+void Net::Context::reset() {
+  std::fill(m_inputs.begin(), m_inputs.end(), std::numeric_limits<double>::quiet_NaN());
+  m_is_set.assign(m_inputs.size(), false);
+  m_n_unset = m_inputs.size();
+  m_first_layer_graph = nullptr;
+}
+
+void Net::Context::set_variable(size_t index, const double val) {
+  m_inputs[index] = val;
+  if (!m_is_set[index]) {
+    m_is_set[index] = true;
+    --m_n_unset;
+  }
+  m_first_layer_graph = nullptr;
+}
+
+const double *Net::Context::precompute(const DenseStack &graph) {
+  if (m_first_layer_graph != &graph) {
+    if (m_n_unset > 0) {
+      const auto unset = std::find(m_is_set.begin(), m_is_set.end(), false);
+      throw std::runtime_error("Net: variable " + graph.variables()[unset - m_is_set.begin()] +
+                               " is not set");
+    }
+    graph.precompute(m_inputs.data(), m_first_layer.data());
+    m_first_layer_graph = &graph;
+  }
+  return m_first_layer.data();
+}
+
+
+Net::Net() : Net("") {
+}
+
+Net::Net(const std::string &parameter_name) :
   m_input_layer_name("input_layer"),
   m_output_layer_name("output_layer"),
-  m_output_node_name("sig_prob") {
+  m_output_node_name("sig_prob"),
+  m_parameter_name(parameter_name) {
 }
 
 Net::~Net() {
 }
 
 void Net::init(const std::string &filename_even,
-                         const std::string &filename_odd) {
-  std::ifstream input_file(filename_even);
-  lwt::GraphConfig config_even = lwt::parse_json_graph(input_file);
-  input_file.close();
+               const std::string &filename_odd) {
+  const GraphNames names{m_input_layer_name, m_output_layer_name,
+                         m_output_node_name, m_parameter_name};
+  m_graph_even = load_graph(filename_even, names);
+  m_graph_odd = load_graph(filename_odd, names);
 
-  input_file.open(filename_odd);
-  lwt::GraphConfig config_odd = lwt::parse_json_graph(input_file);
-  input_file.close();
+  if (m_graph_even->variables() != m_graph_odd->variables()) {
+    throw std::runtime_error("Net: networks of both folds need the same inputs");
+  }
 
-  m_graph_even = std::make_unique<lwt::LightweightGraph>(config_even, m_output_layer_name);
-  m_graph_odd = std::make_unique<lwt::LightweightGraph>(config_odd, m_output_layer_name);
+  m_variable_index.clear();
+  for (size_t i = 0; i < variables().size(); ++i) {
+    m_variable_index[variables()[i]] = i;
+  }
 
-  // Create empty map for input layer
-  m_val_map = &m_node_map[m_input_layer_name];
+  m_context = make_context();
+}
+
+size_t Net::variable_index(const std::string &name) const {
+  const auto it = m_variable_index.find(name);
+  if (it == m_variable_index.end()) {
+    throw std::out_of_range("Net: unknown variable " + name);
+  }
+  return it->second;
+}
+
+const std::vector<std::string> &Net::variables() const {
+  return m_graph_even->variables();
+}
+
+Net::Context Net::make_context() const {
+  Context context;
+  context.m_inputs.resize(variables().size());
+  context.m_first_layer.resize(std::max(m_graph_even->first_layer_size(),
+                                        m_graph_odd->first_layer_size()));
+  context.m_scratch.resize(std::max(m_graph_even->scratch_size(),
+                                    m_graph_odd->scratch_size()));
+  context.reset();
+  return context;
 }
 
 void Net::reset() {
-  m_val_map->clear();
+  m_context.reset();
 }
 
 void Net::set_variable(const std::string &name, const double val) {
-  (*m_val_map)[name] = val;
+  // Variables that are not inputs of the network are ignored, inputs that
+  // are not set are reported by 'evaluate'
+  const auto it = m_variable_index.find(name);
+  if (it != m_variable_index.end()) {
+    m_context.set_variable(it->second, val);
+  }
+}
+
+void Net::set_variable(size_t index, const double val) {
+  m_context.set_variable(index, val);
 }
 
 float Net::evaluate(Fold fold) {
-  const lwt::LightweightGraph *graph = nullptr;
-  if (fold == Fold::Even) {
-    graph = m_graph_odd.get();
-  } else if (fold == Fold::Odd) {
-    graph = m_graph_even.get();
-  } else {
+  return evaluate(m_context, fold);
+}
+
+float Net::evaluate(Context &context, Fold fold) const {
+  if (fold != Fold::Even && fold != Fold::Odd) {
     return -999.0;
   }
 
-  const auto &result = graph->compute(m_node_map);
-  return result.at(m_output_node_name);
+  const DenseStack &dense = graph(fold);
+  return dense.evaluate(context.precompute(dense), 0.0, context.m_scratch.data());
+}
+
+const DenseStack &Net::graph(Fold fold) const {
+  // Apply the network trained on the other fold
+  return fold == Fold::Even ? *m_graph_odd : *m_graph_even;
 }
@@ -1,58 +1,106 @@
 #include "ParametricNet/ParametricNet.h"
 
-#include <fstream>
+#include <stdexcept>
 
-#include "lwtnn/LightweightGraph.hh"
-#include "lwtnn/parse_json.hh"
+#include "DenseStack.h"
 
 
-ParametricNet::ParametricNet() :
-  m_input_layer_name("input_layer"),
-  m_output_layer_name("output_layer"),
-  m_output_node_name("sig_prob"),
-  m_parameter_name("mass") {
+ParametricNet::ParametricNet() : Net("mass") {
 }
 
 ParametricNet::~ParametricNet() {
 }
 
-void ParametricNet::init(const std::string &filename_even,
-                         const std::string &filename_odd) {
-  std::ifstream input_file(filename_even);
-  lwt::GraphConfig config_even = lwt::parse_json_graph(input_file);
-  input_file.close();
+float ParametricNet::evaluate(float parameter, Fold fold) {
+  return evaluate(m_context, parameter, fold);
+}
 
-  input_file.open(filename_odd);
-  lwt::GraphConfig config_odd = lwt::parse_json_graph(input_file);
-  input_file.close();
+void ParametricNet::evaluate(const std::vector<float> &parameters, Fold fold,
+                             std::vector<float> &scores) {
+  evaluate(m_context, parameters, fold, scores);
+}
+
+void ParametricNet::evaluate(const std::vector<double> &inputs,
+                             const std::vector<Fold> &folds,
+                             const std::vector<float> &parameters,
+                             std::vector<float> &scores) {
+  evaluate(m_context, inputs, folds, parameters, scores);
+}
 
-  m_graph_even = std::make_unique<lwt::LightweightGraph>(config_even, m_output_layer_name);
-  m_graph_odd = std::make_unique<lwt::LightweightGraph>(config_odd, m_output_layer_name);
+float ParametricNet::evaluate(Context &context, float parameter, Fold fold) const {
+  if (fold != Fold::Even && fold != Fold::Odd) {
+    return -999.0;
+  }
 
-  // Create empty map for input layer
-  m_val_map = &m_node_map[m_input_layer_name];
+  // The first layer is only recomputed if the variables or fold changed
+  const DenseStack &dense = graph(fold);
+  return dense.evaluate(context.precompute(dense), parameter, context.m_scratch.data());
 }
 
-void ParametricNet::reset() {
-  m_val_map->clear();
+void ParametricNet::evaluate(Context &context, const std::vector<float> &parameters,
+                             Fold fold, std::vector<float> &scores) const {
+  const DenseStack &dense = graph(fold);
+  const double *first_layer = context.precompute(dense);
+
+  scores.resize(parameters.size());
+  dense.evaluate(first_layer, parameters.data(), parameters.size(), scores.data(),
+                 context.m_scratch.data());
 }
 
-void ParametricNet::set_variable(const std::string &name, const double val) {
-  (*m_val_map)[name] = val;
+void ParametricNet::evaluate(Context &context,
+                             const std::vector<double> &inputs,
+                             const std::vector<Fold> &folds,
+                             const std::vector<float> &parameters,
+                             std::vector<float> &scores) const {
+  const size_t n_variables = variables().size();
+  const size_t n_events = folds.size();
+  const size_t n_parameters = parameters.size();
+  if (inputs.size() != n_events * n_variables) {
+    throw std::invalid_argument("ParametricNet: inputs do not match the number of events");
+  }
+
+  // The first layer buffer no longer belongs to the event in the context
+  context.m_first_layer_graph = nullptr;
+  double *first_layer = context.m_first_layer.data();
+  double *scratch = context.m_scratch.data();
+
+  scores.resize(n_events * n_parameters);
+  for (size_t i = 0; i < n_events; ++i) {
+    const DenseStack &dense = graph(folds[i]);
+    dense.precompute(inputs.data() + i * n_variables, first_layer);
+
+    dense.evaluate(first_layer, parameters.data(), n_parameters,
+                   scores.data() + i * n_parameters, scratch);
+  }
 }
 
-float ParametricNet::evaluate(float parameter, Fold fold) {
-  (*m_val_map)[m_parameter_name] = parameter;
-
-  const lwt::LightweightGraph *graph = nullptr;
-  if (fold == Fold::Even) {
-    graph = m_graph_odd.get();
-  } else if (fold == Fold::Odd) {
-    graph = m_graph_even.get();
-  } else {
-    return -999.0;
+void ParametricNet::evaluate_rows(const std::vector<double> &rows,
+                                  const std::vector<Fold> &folds,
+                                  std::vector<float> &scores) {
+  evaluate_rows(m_context, rows, folds, scores);
+}
+
+void ParametricNet::evaluate_rows(Context &context,
+                                  const std::vector<double> &rows,
+                                  const std::vector<Fold> &folds,
+                                  std::vector<float> &scores) const {
+  const size_t row_size = variables().size() + 1;
+  const size_t n_rows = folds.size();
+  if (rows.size() != n_rows * row_size) {
+    throw std::invalid_argument("ParametricNet: rows do not match the number of folds");
   }
 
-  const auto &result = graph->compute(m_node_map);
-  return result.at(m_output_node_name);
+  scores.resize(n_rows);
+  size_t start = 0;
+  while (start < n_rows) {
+    // Consecutive rows of the same fold are evaluated together
+    size_t stop = start + 1;
+    while (stop < n_rows && folds[stop] == folds[start]) {
+      ++stop;
+    }
+
+    graph(folds[start]).evaluate_rows(rows.data() + start * row_size, stop - start,
+                                      scores.data() + start, context.m_scratch.data());
+    start = stop;
+  }
 }
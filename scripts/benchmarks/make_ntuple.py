@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+import argparse
+
+import numpy as np
+import uproot
+
+
+MASSES = [251, 260, 280, 300, 325, 350, 400, 450, 500, 550, 600, 700, 800, 900, 1000]
+BKG_TREES = ["ttbar", "ttbarFakesMC", "Ztautau", "Fake", "VH",
+             "Htautau", "ttH", "Wtaunu", "Diboson", "singletop"]
+INPUT_VARS = ["dRTauTau", "dRBB", "mMMC", "mBB", "mHH"]
+
+
+def make_events(rng, n_events, mass=None):
+    # Rough imitation of the input distributions. The signal peaks in mHH at
+    # the resonance mass, the background falls off exponentially.
+    if mass is None:
+        mHH = 250. + rng.exponential(150., size=n_events)
+    else:
+        mHH = rng.normal(mass, 0.05 * mass, size=n_events)
+
+    scale = np.clip(mHH / 500., 0.5, 2.)
+    return {
+        "dRTauTau": rng.uniform(0.2, 4., size=n_events) / scale,
+        "dRBB": rng.uniform(0.2, 4., size=n_events) / scale,
+        "mMMC": rng.normal(125. if mass else 100., 20., size=n_events),
+        "mBB": rng.normal(125. if mass else 110., 25., size=n_events),
+        "mHH": mHH,
+    }
+
+
+def make_ntuple(filename, n_events, masses=MASSES, bkg_trees=BKG_TREES,
+                n_extra_branches=20, chunk_size=1000000, seed=42):
+    # Writes one tree per signal mass (Xtohh<mass>) and background process with
+    # 'n_events' entries each. Unused branches mimic the width of real ntuples.
+    rng = np.random.RandomState(seed)
+    extra_branches = ["extra{}".format(i) for i in range(n_extra_branches)]
+
+    branch_types = {var: np.float32 for var in INPUT_VARS + extra_branches}
+    branch_types["weight"] = np.float32
+    branch_types["event_number"] = np.int64
+
+    trees = [("Xtohh{}".format(mass), mass) for mass in masses]
+    trees += [(tree, None) for tree in bkg_trees]
+
+    f = uproot.recreate(filename)
+    for tree, mass in trees:
+        f[tree] = uproot.newtree(branch_types)
+
+        for start in range(0, n_events, chunk_size):
+            n_chunk = min(chunk_size, n_events - start)
+
+            arrays = make_events(rng, n_chunk, mass)
+            for branch in extra_branches:
+                arrays[branch] = rng.normal(size=n_chunk)
+
+            # Small fraction of negative weights to exercise the selection
+            arrays["weight"] = rng.exponential(1e-3, size=n_chunk) * rng.choice(
+                [-1., 1.], p=[0.05, 0.95], size=n_chunk)
+            arrays["event_number"] = rng.randint(0, 2**40, size=n_chunk)
+
+            f[tree].extend({name: np.asarray(arr, dtype=branch_types[name])
+                            for name, arr in arrays.items()})
+
+    f.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("outfile")
+    parser.add_argument("-n", "--events", type=int, default=100000,
+                        help="Number of events per tree")
+    parser.add_argument("--masses", type=int, nargs="+", default=MASSES)
+    parser.add_argument("--bkg-trees", nargs="+", default=BKG_TREES)
+    parser.add_argument("--extra-branches", type=int, default=20,
+                        help="Number of additional branches not used in the training")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    make_ntuple(args.outfile, args.events, args.masses, args.bkg_trees,
+                args.extra_branches, seed=args.seed)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+import argparse
+import csv
+import datetime
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, SCRIPTS_DIR)
+sys.path.insert(0, os.path.join(SCRIPTS_DIR, "plots"))
+
+from make_ntuple import make_ntuple, BKG_TREES
+
+
+STAGES = ["load", "stream", "train", "evaluate", "rebin"]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def measure(func, *args):
+    # Returns the result, the wall time and the increase of the peak RSS
+    rss_before = peak_rss_mb()
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start, peak_rss_mb() - rss_before
+
+
+def stream(loader, ntuple):
+    return sum(len(Y) for _, Y, _ in loader.iterate(ntuple))
+
+
+def rebin_asimov(n_events, n_bins=1000):
+    import ROOT as R
+    from ml_evaluation_tools import asimov_significance
+    from rebin import rebin
+
+    rng = np.random.RandomState(42)
+    h_sig = R.TH1F("h_sig", "", n_bins, 0, 1)
+    h_bkg = R.TH1F("h_bkg", "", n_bins, 0, 1)
+    for hist, scores in [(h_sig, rng.beta(5, 2, size=n_events)),
+                         (h_bkg, rng.beta(2, 5, size=n_events))]:
+        hist.Sumw2()
+        hist.SetDirectory(0)
+        hist.FillN(n_events, scores, np.full(n_events, 1e-3))
+
+    return measure(lambda: asimov_significance(*rebin(h_sig, h_bkg)))
+
+
+def run_stage(task):
+    # Runs all stages up to 'stage' and measures only the last one.
+    # Executed in a fresh process so that the peak RSS is not polluted.
+    stage, ntuple, n_events, epochs = task
+
+    if stage == "rebin":
+        return rebin_asimov(n_events)[1:] + (peak_rss_mb(),)
+
+    from dataloader import DataLoader
+    loader = DataLoader(bkg_trees=BKG_TREES)
+
+    if stage == "stream":
+        return measure(stream, loader, ntuple)[1:] + (peak_rss_mb(),)
+
+    (X, Y, W), t, rss = measure(loader.load, ntuple)
+    if stage == "load":
+        return t, rss, peak_rss_mb()
+
+    from parametricnet import ParametricNet
+    from evaluation import evaluate
+
+    # Half of the events for training, the other half for evaluation
+    X_train, Y_train, W_train = X[::2], Y[::2], W[::2]
+    X_test, Y_test, W_test = X[1::2], Y[1::2], W[1::2]
+    del X, Y, W
+
+    net = ParametricNet(epochs=epochs)
+    _, t, rss = measure(net.train, X_train, Y_train, W_train)
+    if stage == "train":
+        return t, rss, peak_rss_mb()
+
+    _, t, rss = measure(evaluate, X_test, Y_test, W_test, loader, net)
+    return t, rss, peak_rss_mb()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=SCRIPTS_DIR).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main(args):
+    commit = git_commit()
+    date = datetime.datetime.now().isoformat()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="pnet_benchmark_")
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    for n_events in args.scales:
+        ntuple = os.path.join(workdir, "ntuple_{}.root".format(n_events))
+        if not os.path.exists(ntuple) and set(args.stages) - set(["rebin"]):
+            print("Generating {} with {} events per tree".format(ntuple, n_events))
+            make_ntuple(ntuple, n_events)
+
+        for stage in args.stages:
+            pool = context.Pool(1)
+            try:
+                wall_time, rss_increase, peak_rss = pool.apply(
+                    run_stage, ((stage, ntuple, n_events, args.epochs),))
+            finally:
+                pool.close()
+                pool.join()
+
+            row = {"commit": commit, "date": date, "stage": stage, "events_per_tree": n_events,
+                   "time_s": wall_time, "peak_rss_increase_mb": rss_increase,
+                   "peak_rss_mb": peak_rss}
+            rows.append(row)
+            print("{stage:>10} {events_per_tree:>10} events: {time_s:8.2f} s, "
+                  "peak RSS +{peak_rss_increase_mb:.0f} MB ({peak_rss_mb:.0f} MB)".format(**row))
+
+    # Results of all commits are collected in one table
+    write_header = not os.path.exists(args.output)
+    with open(args.output, "a") as f:
+        writer = csv.DictWriter(f, fieldnames=["commit", "date", "stage", "events_per_tree",
+                                               "time_s", "peak_rss_increase_mb", "peak_rss_mb"])
+        if write_header:
+            writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="Number of events per tree")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("-e", "--epochs", type=int, default=2,
+                        help="Number of epochs in the training stage")
+    parser.add_argument("--workdir", default=None,
+                        help="Directory for the synthetic ntuples (reused if present)")
+    parser.add_argument("-o", "--output", default="benchmark_results.csv")
+    args = parser.parse_args()
+    main(args)
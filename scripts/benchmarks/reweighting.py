@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataloader import DataLoader
+
+
+def reweighting_reference(sig_df, bkg_df, weight_name="weight"):
+    # Previous implementation with a boolean mask per mass point
+    bkg_weight = bkg_df[weight_name].sum()
+
+    masspoints = sig_df.mass.unique()
+    weight_per_masspoint = bkg_weight / len(masspoints)
+
+    scale_map = {}
+    for mass in masspoints:
+        weight_sum = sig_df.loc[sig_df.mass == mass, weight_name].sum()
+        scale_map[mass] = weight_per_masspoint / weight_sum
+
+    bkg_df["weight_scaled"] = bkg_df[weight_name]
+    sig_df["weight_scaled"] = sig_df[weight_name] * sig_df["mass"].map(scale_map)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--events", default=10000000, type=int,
+                    help="Number of signal (and background) events")
+parser.add_argument("--masses", default=[251, 260, 280, 300, 325, 350, 400, 450,
+                                         500, 550, 600, 700, 800, 900, 1000],
+                    nargs="+", type=int)
+parser.add_argument("--repeat", default=3, type=int)
+args = parser.parse_args()
+
+
+rng = np.random.RandomState(42)
+sig = {"mass": rng.choice(args.masses, size=args.events),
+       "weight": rng.exponential(size=args.events)}
+bkg = {"mass": np.full(args.events, -1, dtype=int),
+       "weight": rng.exponential(size=args.events)}
+
+sig_df = pd.DataFrame(sig)
+bkg_df = pd.DataFrame(bkg)
+
+loader = DataLoader()
+
+t_reference = min(timeit.repeat(lambda: reweighting_reference(sig_df, bkg_df),
+                                number=1, repeat=args.repeat))
+t_loader = min(timeit.repeat(lambda: loader.reweighting(sig, bkg),
+                             number=1, repeat=args.repeat))
+
+# Both implementations have to agree
+assert np.allclose(sig_df["weight_scaled"].values, sig["weight_scaled"])
+
+print("Events: {}, mass points: {}".format(args.events, len(args.masses)))
+print("Per-mass masks (pandas): {:.3f} s".format(t_reference))
+print("Bincount (DataLoader):   {:.3f} s".format(t_loader))
+print("Speedup:                 {:.1f}x".format(t_reference / t_loader))
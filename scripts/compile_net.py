@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+import argparse
+import json
+import struct
+
+import numpy as np
+
+
+# Binary network format read by Root/BinaryNetwork.cxx (see BinaryNetwork.h)
+MAGIC = b"PNETBIN\0"
+VERSION = 1
+
+ACTIVATIONS = ["linear", "sigmoid", "rectified", "tanh", "hard_sigmoid", "elu"]
+
+
+def dense_stack(spec, output_layer):
+    # Layers leading to the output, ordered from the input to the output
+    layers = []
+    node = spec["nodes"][spec["outputs"][output_layer]["node_index"]]
+    while node["type"] == "feed_forward":
+        layer = spec["layers"][node["layer_index"]]
+        if layer["architecture"] != "dense":
+            raise ValueError("Only dense layers are supported, got " + layer["architecture"])
+        layers.append(layer)
+        node = spec["nodes"][node["sources"][0]]
+
+    if node["type"] != "input" or not layers:
+        raise ValueError("Network is not a chain of dense layers")
+
+    return spec["inputs"][node["sources"][0]], layers[::-1]
+
+
+def activation(layer):
+    # Either the name or a dictionary with the name and alpha
+    act = layer["activation"]
+    if isinstance(act, dict):
+        return act["function"], act.get("alpha", 0.)
+    return act, 0.
+
+
+def activate(x, function, alpha=0.):
+    # In-place activation with the same definitions as lwtnn
+    if function == "rectified":
+        np.maximum(x, 0., out=x)
+    elif function == "sigmoid":
+        np.clip(x, -30., 30., out=x)
+        np.negative(x, out=x)
+        np.exp(x, out=x)
+        x += 1.
+        np.reciprocal(x, out=x)
+    elif function == "tanh":
+        np.tanh(x, out=x)
+    elif function == "elu":
+        neg = x < 0
+        x[neg] = alpha * np.expm1(x[neg])
+    elif function == "hard_sigmoid":
+        x *= 0.2
+        x += 0.5
+        np.clip(x, 0., 1., out=x)
+    elif function != "linear":
+        raise ValueError("Unsupported activation " + function)
+    return x
+
+
+def pack_string(s):
+    s = s.encode("utf-8")
+    return struct.pack("<I", len(s)) + s
+
+
+def compile_net(spec, output_layer="output_layer"):
+    inputs, layers = dense_stack(spec, output_layer)
+    variables = inputs["variables"]
+    labels = spec["outputs"][output_layer]["labels"]
+
+    header = MAGIC + struct.pack("<I", VERSION)
+    header += struct.pack("<I", len(variables))
+    header += b"".join(pack_string(var["name"]) for var in variables)
+    header += struct.pack("<I", len(labels))
+    header += b"".join(pack_string(label) for label in labels)
+    header += struct.pack("<I", len(layers))
+    header += b"\0" * (-len(header) % 8)
+
+    chunks = [header,
+              np.array([var["offset"] for var in variables], dtype="<f8").tobytes(),
+              np.array([var["scale"] for var in variables], dtype="<f8").tobytes()]
+
+    n_inputs = len(variables)
+    for layer in layers:
+        function, alpha = activation(layer)
+        if function not in ACTIVATIONS:
+            raise ValueError("Unsupported activation " + function)
+
+        bias = np.array(layer["bias"], dtype="<f8")
+        weights = np.array(layer["weights"], dtype="<f8")
+        if weights.size != n_inputs * bias.size:
+            raise ValueError("Layer sizes do not match")
+
+        chunks.append(struct.pack("<IIIId", n_inputs, bias.size,
+                                  ACTIVATIONS.index(function), 0, alpha))
+        chunks += [weights.tobytes(), bias.tobytes()]
+        n_inputs = bias.size
+
+    return b"".join(chunks)
+
+
+def read_net(data):
+    # Inverse of 'compile_net' with the layout read by Root/BinaryNetwork.cxx.
+    # Returns the variable names, labels, offsets, scales and the layers as
+    # (weights [n_outputs x n_inputs], bias, activation, alpha).
+    pos = 0
+
+    def unpack(fmt):
+        nonlocal pos
+        values = struct.unpack_from(fmt, data, pos)
+        pos += struct.calcsize(fmt)
+        return values
+
+    def doubles(n):
+        nonlocal pos
+        values = np.frombuffer(data, dtype="<f8", count=n, offset=pos)
+        pos += 8 * n
+        return values
+
+    def strings():
+        values = []
+        for _ in range(unpack("<I")[0]):
+            length, = unpack("<I")
+            values.append(unpack("{}s".format(length))[0].decode("utf-8"))
+        return values
+
+    if data[:len(MAGIC)] != MAGIC or struct.unpack_from("<I", data, len(MAGIC))[0] != VERSION:
+        raise ValueError("Not a binary network of version {}".format(VERSION))
+    pos = len(MAGIC) + 4
+
+    variables = strings()
+    labels = strings()
+    n_layers, = unpack("<I")
+    pos += -pos % 8
+
+    offsets = doubles(len(variables))
+    scales = doubles(len(variables))
+    layers = []
+    for _ in range(n_layers):
+        n_inputs, n_outputs, function, _, alpha = unpack("<IIIId")
+        weights = doubles(n_inputs * n_outputs).reshape(n_outputs, n_inputs)
+        layers.append((weights, doubles(n_outputs), ACTIVATIONS[function], alpha))
+
+    return variables, labels, offsets, scales, layers
+
+
+def forward(X, offsets, scales, layers):
+    # Outputs of a dense stack for unscaled inputs in the lwtnn convention
+    x = (X + offsets) * scales
+    for weights, bias, function, alpha in layers:
+        x = activate(x.dot(weights.T) + bias, function, alpha)
+    return x
+
+
+def check_net(spec, data, output_layer="output_layer", n_probes=16):
+    # Compares the network read back from 'data' to the JSON network on
+    # random inputs, with different values for every variable
+    inputs, layers = dense_stack(spec, output_layer)
+    variables = inputs["variables"]
+    offsets = np.array([var["offset"] for var in variables], dtype=np.float64)
+    scales = np.array([var["scale"] for var in variables], dtype=np.float64)
+
+    expected_layers = []
+    n_inputs = len(variables)
+    for layer in layers:
+        bias = np.array(layer["bias"], dtype=np.float64)
+        weights = np.array(layer["weights"], dtype=np.float64).reshape(len(bias), n_inputs)
+        expected_layers.append((weights, bias) + activation(layer))
+        n_inputs = len(bias)
+
+    names, labels, binary_offsets, binary_scales, binary_layers = read_net(data)
+    if names != [var["name"] for var in variables] or \
+       labels != spec["outputs"][output_layer]["labels"]:
+        raise ValueError("Binary network has different inputs or outputs than the JSON network")
+
+    X = np.random.RandomState(0).normal(size=(n_probes, len(variables))) / scales - offsets
+    expected = forward(X, offsets, scales, expected_layers)
+    result = forward(X, binary_offsets, binary_scales, binary_layers)
+    if not np.allclose(result, expected, rtol=0., atol=1e-12):
+        raise ValueError("Binary network does not reproduce the JSON network")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("spec", help="lwtnn network (output of kerasfunc2json.py)")
+    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("--output-layer", default="output_layer")
+    args = parser.parse_args()
+
+    with open(args.spec) as f_spec:
+        spec = json.load(f_spec)
+
+    data = compile_net(spec, args.output_layer)
+    check_net(spec, data, args.output_layer)
+
+    with open(args.output, "wb") as outf:
+        outf.write(data)
@@ -1,9 +1,16 @@
+import os
 import re
+import json
+import hashlib
+import shutil
 import logging
+import tempfile
+from collections import OrderedDict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 import uproot
 import numpy as np
-import pandas as pd
 from sklearn.utils import shuffle
 
 
@@ -29,8 +36,22 @@ class DataLoader:
         self.fold = kwargs.setdefault("fold", "even")
         assert self.fold == "even" or self.fold == "odd"
 
+        # Number of tree entries read at once in streaming mode
+        self.chunk_size = kwargs.setdefault("chunk_size", 100000)
 
-    def signal_df(self, infile):
+        # Directory to cache the preprocessed arrays in (disabled if None)
+        self.cache_dir = kwargs.setdefault("cache_dir", None)
+
+        # Number of trees read concurrently and type of pool ("thread" or "process")
+        self.loader_workers = kwargs.setdefault("loader_workers", 1)
+        self.loader_pool = kwargs.setdefault("loader_pool", "thread")
+        assert self.loader_pool == "thread" or self.loader_pool == "process"
+
+        # Store X and W as float32 and Y as int8 instead of float64 / int
+        self.compact = kwargs.setdefault("compact", False)
+
+
+    def signal_trees(self, infile):
         # Trees are saved as bytes
         trees = [key.decode() for key in infile.keys()]
 
@@ -49,10 +70,14 @@ class DataLoader:
             mass_map[int(mass)] = treename
             logging.info("Adding signal tree {} with mass {}".format(treename, mass))
 
-        # Setting mass transform
-        self.mass_min = float(min(mass_map.keys()))
-        self.mass_max = float(max(mass_map.keys()))
-        self.mass_transform = lambda x: (x - self.mass_min) / (self.mass_max - self.mass_min)
+        self.set_mass_transform(min(mass_map.keys()), max(mass_map.keys()))
+
+        return mass_map
+
+
+    def set_mass_transform(self, mass_min, mass_max):
+        self.mass_min = float(mass_min)
+        self.mass_max = float(mass_max)
 
         logging.info("Using mass transform (m - {mass_min}) / ({mass_max} - {mass_min})".format(
             mass_min=self.mass_min, mass_max=self.mass_max))
@@ -60,90 +85,329 @@ class DataLoader:
         assert abs(self.mass_transform(self.mass_min)) < 1e-9
         assert abs(self.mass_transform(self.mass_max) - 1.) < 1e-9
 
-        # Read dataframes
-        dfs = []
-        for mass, tree in mass_map.items():
-            df = infile[tree].pandas.df()
-            df["mass"] = mass
-            df["mass_scaled"] = self.mass_transform(mass)
-            df["signal"] = 1
-            dfs.append(df)
 
-        return pd.concat(dfs)
+    def mass_transform(self, x):
+        return (x - self.mass_min) / (self.mass_max - self.mass_min)
 
 
-    def background_df(self, infile):
-        dfs = []
-        for tree in self.bkg_trees:
-            df = infile[tree].pandas.df()
-            df["mass"] = -1
-            df["mass_scaled"] = -1.
-            df["signal"] = 0
-            dfs.append(df)
+    def signal_arrays(self, infile, fold=None):
+        mass_map = self.signal_trees(uproot.open(infile))
+        masses = list(mass_map.keys())
+
+        # Read arrays
+        arrays = self.read_trees(infile, [mass_map[mass] for mass in masses], fold)
+        for mass, arr in zip(masses, arrays):
+            self.add_signal_columns(arr, mass)
+
+        return concatenate(arrays)
+
+
+    def background_arrays(self, infile, fold=None):
+        arrays = self.read_trees(infile, self.bkg_trees, fold)
+        for tree, arr in zip(self.bkg_trees, arrays):
+            self.add_background_columns(arr)
             logging.info("Adding background tree " + tree)
 
-        return pd.concat(dfs)
+        return concatenate(arrays)
+
+
+    def add_signal_columns(self, arrays, mass):
+        n_events = len(arrays[self.weight_name])
+        arrays["mass"] = np.full(n_events, mass, dtype=int)
+        arrays["mass_scaled"] = np.full(n_events, self.mass_transform(mass))
+        arrays["signal"] = np.ones(n_events, dtype=int)
+
+
+    def add_background_columns(self, arrays):
+        n_events = len(arrays[self.weight_name])
+        arrays["mass"] = np.full(n_events, -1, dtype=int)
+        arrays["mass_scaled"] = np.full(n_events, -1.)
+        arrays["signal"] = np.zeros(n_events, dtype=int)
+
+
+    def branches(self):
+        # Only the branches required for training are read from the trees
+        branches = self.input_vars + [self.weight_name, self.event_number_variable]
+        return list(OrderedDict.fromkeys(branches))
+
+
+    def read_tree(self, infile, tree, fold=None):
+        arrays = infile[tree].arrays(self.branches(), namedecode="utf-8")
+        return self.apply_selection(arrays, fold)
+
+
+    def read_trees(self, infile, trees, fold=None):
+        # Reads the trees concurrently if more than one worker is configured.
+        # The results are returned in the order of 'trees'.
+        if self.loader_workers <= 1:
+            f = uproot.open(infile)
+            return [self.read_tree(f, tree, fold) for tree in trees]
+
+        logging.info("Reading {} trees with {} {} workers".format(
+            len(trees), self.loader_workers, self.loader_pool))
 
+        pool_type = ThreadPool if self.loader_pool == "thread" else Pool
+        pool = pool_type(self.loader_workers)
+        try:
+            return pool.map(read_tree_task, [(self, infile, tree, fold) for tree in trees])
+        finally:
+            pool.close()
+            pool.join()
 
-    def apply_selection(self, df):
-        sel_pos_weight = df[self.weight_name] > 0
 
-        if self.fold == "even":
-            sel_fold = df[self.event_number_variable] % 2 == 0
-        elif self.fold == "odd":
-            sel_fold = df[self.event_number_variable] % 2 == 1
+    def iterate_tree(self, infile, tree, branches=None):
+        # Selected chunks of at most 'chunk_size' entries
+        if branches is None:
+            branches = self.branches()
+
+        for arrays in infile[tree].iterate(branches, entrysteps=self.chunk_size,
+                                           namedecode="utf-8"):
+            arrays = self.apply_selection(arrays)
+            if len(arrays[self.weight_name]) > 0:
+                yield arrays
+
+
+    def apply_selection(self, arrays, fold=None):
+        # fold: "even", "odd" or "both" (defaults to the configured fold)
+        if fold is None:
+            fold = self.fold
+
+        sel_pos_weight = arrays[self.weight_name] > 0
+
+        if fold == "even":
+            sel_fold = arrays[self.event_number_variable] % 2 == 0
+        elif fold == "odd":
+            sel_fold = arrays[self.event_number_variable] % 2 == 1
+        elif fold == "both":
+            sel_fold = True
         else:
             raise RuntimeError("Error in fold specification")
 
-        return df[sel_pos_weight & sel_fold].copy()
-
+        sel = sel_pos_weight & sel_fold
+        return {name: arr[sel] for name, arr in arrays.items()}
 
-    def reweighting(self, sig_df, bkg_df):
-        # Total background weight
-        bkg_weight = bkg_df[self.weight_name].sum()
 
+    def scale_factors(self, sig_sumw, bkg_sumw):
         # Equalize signal weights (total sig weight should match bkg)
-        masspoints = sig_df.mass.unique()
-        num_masspoints = len(masspoints)
-        weight_per_masspoint = bkg_weight / num_masspoints
+        # sig_sumw: mapping of signal mass to its sum of weights
+        weight_per_masspoint = bkg_sumw / len(sig_sumw)
 
         scale_map = {}
-        for mass in masspoints:
-            weight_sum = sig_df.loc[sig_df.mass == mass, self.weight_name].sum()
+        for mass, weight_sum in sig_sumw.items():
             scale_map[mass] = weight_per_masspoint / weight_sum
 
             logging.info("Reweighting signal mass {} with factor {}".format(mass, scale_map[mass]))
 
-        bkg_df["weight_scaled"] = bkg_df[self.weight_name]
-        sig_df["weight_scaled"] = sig_df[self.weight_name] * sig_df["mass"].map(scale_map)
+        return scale_map
+
+
+    def reweighting(self, sig, bkg):
+        # Total background weight
+        bkg_weight = bkg[self.weight_name].sum()
+
+        # Signal masses are integers and are used directly as bin indices
+        # so that all sums of weights are computed in a single pass
+        n_events = np.bincount(sig["mass"])
+        sumw = np.bincount(sig["mass"], weights=sig[self.weight_name])
+        masspoints = np.flatnonzero(n_events)
+
+        scale_map = self.scale_factors(dict(zip(masspoints, sumw[masspoints])), bkg_weight)
+
+        scale = np.zeros(len(sumw))
+        scale[masspoints] = [scale_map[mass] for mass in masspoints]
+
+        bkg["weight_scaled"] = bkg[self.weight_name]
+        sig["weight_scaled"] = sig[self.weight_name] * scale[sig["mass"]]
 
         # Sanity check
-        assert abs(sig_df["weight_scaled"].sum() - bkg_df["weight_scaled"].sum()) < 1e-3
+        assert abs(sig["weight_scaled"].sum() - bkg["weight_scaled"].sum()) < 1e-3
+
+
+    def training_arrays(self, arrays):
+        float_dtype = np.float32 if self.compact else np.float64
+        label_dtype = np.int8 if self.compact else int
+
+        # Columns are filled directly into the final dtype
+        columns = self.input_vars + ["mass_scaled"]
+        X = np.empty((len(arrays["signal"]), len(columns)), dtype=float_dtype)
+        for i, col in enumerate(columns):
+            X[:, i] = arrays[col]
+
+        Y = arrays["signal"].astype(label_dtype)
+        W = arrays["weight_scaled"].astype(float_dtype, copy=False)
+        return X, Y, W
+
+
+    def cache_key(self, infile, fold=None):
+        # The input file is identified by path, size and modification time
+        # to avoid hashing the content of the full ntuple
+        stat = os.stat(infile)
+        config = {
+            "infile": os.path.realpath(infile),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sig_tree_regex": self.sig_tree_regex,
+            "bkg_trees": list(self.bkg_trees),
+            "input_vars": list(self.input_vars),
+            "weight_name": self.weight_name,
+            "event_number_variable": self.event_number_variable,
+            "fold": fold or self.fold,
+            "compact": self.compact
+        }
+
+        return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+    def load_cache(self, infile, fold=None):
+        cache_path = os.path.join(self.cache_dir, self.cache_key(infile, fold))
+        if not os.path.isdir(cache_path):
+            return None
+
+        logging.info("Loading cached arrays from " + cache_path)
+        with open(os.path.join(cache_path, "meta.json")) as f:
+            meta = json.load(f)
+
+        self.set_mass_transform(meta["mass_min"], meta["mass_max"])
+
+        # Copy-on-write memory map: in-place preprocessing does not touch the cache
+        X, Y, W = [np.load(os.path.join(cache_path, name + ".npy"), mmap_mode="c")
+                   for name in ["X", "Y", "W"]]
+
+        return X, Y, W
+
+
+    def save_cache(self, infile, X, Y, W, fold=None):
+        cache_path = os.path.join(self.cache_dir, self.cache_key(infile, fold))
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        # Write into a temporary directory first so that concurrent jobs never
+        # see an incomplete cache entry
+        tmp_path = tempfile.mkdtemp(dir=self.cache_dir)
+        for name, arr in [("X", X), ("Y", Y), ("W", W)]:
+            np.save(os.path.join(tmp_path, name + ".npy"), arr)
+
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"infile": infile, "mass_min": self.mass_min,
+                       "mass_max": self.mass_max}, f, indent=4)
+
+        try:
+            os.rename(tmp_path, cache_path)
+            logging.info("Cached arrays in " + cache_path)
+        except OSError:
+            # Another job created the same entry in the meantime
+            shutil.rmtree(tmp_path)
+
+
+    def prepare(self, sig, bkg):
+        logging.info("Reweighting signal so that the integral matches background")
+        self.reweighting(sig, bkg)
+
+        # Arrays for training
+        X, Y, W = self.training_arrays(concatenate([sig, bkg]))
+
+        return shuffle(X, Y, W)
 
 
     def load(self, infile):
+        if self.cache_dir is not None:
+            cached = self.load_cache(infile)
+            if cached is not None:
+                return cached
+
         logging.info("Loading " + infile)
-        f = uproot.open(infile)
 
-        sig_df = self.signal_df(f)
-        bkg_df = self.background_df(f)
+        # Selection is applied per tree while reading
+        logging.info("Applying selection for fold: " + self.fold)
+        sig = self.signal_arrays(infile)
+        bkg = self.background_arrays(infile)
+
+        X, Y, W = self.prepare(sig, bkg)
+
+        if self.cache_dir is not None:
+            self.save_cache(infile, X, Y, W)
+
+        return X, Y, W
+
+
+    def load_folds(self, infile):
+        # Reads the ntuple once and returns {fold: (X, Y, W)} for the even and
+        # odd fold. Both folds are reweighted independently.
+        folds = ["even", "odd"]
+
+        if self.cache_dir is not None:
+            cached = [self.load_cache(infile, fold) for fold in folds]
+            if all(c is not None for c in cached):
+                return dict(zip(folds, cached))
+
+        logging.info("Loading " + infile)
+
+        # Only the positive weight selection is applied while reading
+        sig = self.signal_arrays(infile, "both")
+        bkg = self.background_arrays(infile, "both")
+
+        datasets = {}
+        for fold in folds:
+            logging.info("Applying selection for fold: " + fold)
+            X, Y, W = self.prepare(self.apply_selection(sig, fold),
+                                   self.apply_selection(bkg, fold))
+
+            if self.cache_dir is not None:
+                self.save_cache(infile, X, Y, W, fold)
+
+            datasets[fold] = (X, Y, W)
+
+        return datasets
+
+
+    def iterate(self, infile):
+        # Streaming version of 'load' yielding (X, Y, W) per chunk of at most
+        # 'chunk_size' entries. Chunks are ordered by tree and not shuffled.
+        logging.info("Streaming " + infile)
+        f = uproot.open(infile)
 
         logging.info("Applying selection for fold: " + self.fold)
-        sig_df = self.apply_selection(sig_df)
-        bkg_df = self.apply_selection(bkg_df)
+        mass_map = self.signal_trees(f)
+
+        # First sweep: sum of weights (only reading the branches needed for that)
+        weight_branches = list(OrderedDict.fromkeys(
+            [self.weight_name, self.event_number_variable]))
+
+        sig_sumw = {}
+        for mass, tree in mass_map.items():
+            sig_sumw[mass] = sum(arrays[self.weight_name].sum()
+                                 for arrays in self.iterate_tree(f, tree, weight_branches))
+
+        bkg_sumw = 0.
+        for tree in self.bkg_trees:
+            bkg_sumw += sum(arrays[self.weight_name].sum()
+                            for arrays in self.iterate_tree(f, tree, weight_branches))
 
         logging.info("Reweighting signal so that the integral matches background")
-        self.reweighting(sig_df, bkg_df)
+        scale_map = self.scale_factors(sig_sumw, bkg_sumw)
 
-        # Combine for training
-        df = pd.concat([sig_df, bkg_df])
+        # Second sweep: preprocessed training arrays
+        for mass, tree in mass_map.items():
+            for arrays in self.iterate_tree(f, tree):
+                self.add_signal_columns(arrays, mass)
+                arrays["weight_scaled"] = arrays[self.weight_name] * scale_map[mass]
+                yield self.training_arrays(arrays)
 
-        # Arrays for training
-        X = df[self.input_vars + ["mass_scaled"]].values
-        Y = df["signal"].values.astype(int)
-        W = df["weight_scaled"].values
+        for tree in self.bkg_trees:
+            logging.info("Adding background tree " + tree)
+            for arrays in self.iterate_tree(f, tree):
+                self.add_background_columns(arrays)
+                arrays["weight_scaled"] = arrays[self.weight_name]
+                yield self.training_arrays(arrays)
 
-        X, Y, W = shuffle(X, Y, W)
 
+def read_tree_task(args):
+    # Every worker opens its own file handle
+    loader, infile, tree, fold = args
+    return loader.read_tree(uproot.open(infile), tree, fold)
 
-        return X, Y, W
+
+def concatenate(arrays):
+    # Concatenate a list of {branch: array} dictionaries column by column
+    return {name: np.concatenate([arr[name] for arr in arrays])
+            for name in arrays[0]}
@@ -1,36 +1,32 @@
 import numpy as np
 
-from scipy.interpolate import interp1d
-from sklearn.metrics import roc_curve, roc_auc_score
+from roc import roc_summary
 
 
-def evaluate(X, Y, W, loader, net):
+def evaluate(X, Y, W, loader, net, roc_bins=None):
+    # roc_bins: use the binned ROC approximation with this many bins
     metrics = {}
 
     masses = np.unique(X[:, -1])
-    bkg_mask = (X[:, -1] < 0)
+    signal_masses = masses[masses >= 0]
+    bkg_idx = np.flatnonzero(X[:, -1] < 0)
 
-    for signal_mass in masses:
-        # Skip background class
-        if signal_mass < 0:
-            continue
+    # Every mass hypothesis is evaluated on its own signal and all background
+    rows = [np.concatenate([np.flatnonzero(X[:, -1] == signal_mass), bkg_idx])
+            for signal_mass in signal_masses]
+    sizes = [len(r) for r in rows]
 
-        pred = net.evaluate(X, signal_mass)
+    # Scale once and predict all mass hypotheses in one batched call
+    X_stacked = net.scale(X)[np.concatenate(rows)]
+    X_stacked[:, -1] = np.repeat(signal_masses, sizes)
+    preds = np.split(net.predict(X_stacked), np.cumsum(sizes)[:-1])
 
-        sig_mask = (X[:, -1] == signal_mass)
-
-        sig_total = W[sig_mask].sum()
-        bkg_total = W[bkg_mask].sum()
-
-        fpr, tpr, thr = roc_curve(Y[sig_mask | bkg_mask], pred[sig_mask | bkg_mask],
-                                  sample_weight=W[sig_mask | bkg_mask])
-        roc = interp1d(tpr, fpr)
-
-        auc = roc_auc_score(Y[sig_mask | bkg_mask], pred[sig_mask | bkg_mask],
-                            sample_weight=W[sig_mask | bkg_mask])
+    for signal_mass, idx, pred in zip(signal_masses, rows, preds):
+        auc, (roc95, roc80) = roc_summary(Y[idx], pred, W[idx], sig_effs=[0.95, 0.8],
+                                          bins=roc_bins)
 
         metrics["AUC_M{:.3f}".format(signal_mass)] = auc
-        metrics["ROC95_M{:.3f}".format(signal_mass)] = roc(0.95)
-        metrics["ROC80_M{:.3f}".format(signal_mass)] = roc(0.8)
+        metrics["ROC95_M{:.3f}".format(signal_mass)] = roc95
+        metrics["ROC80_M{:.3f}".format(signal_mass)] = roc80
 
     return metrics
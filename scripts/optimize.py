@@ -1,74 +1,161 @@
 #!/usr/bin/env python
 import argparse
-import pnet
+import logging
+import multiprocessing
+import queue
+import shutil
 
-import uproot
 import numpy as np
-from hyperopt import hp, fmin, tpe
-
-
-from sklearn.model_selection import StratifiedKFold
-
-
-def evaluate(X, Y, W, scaler, model):
-    X[:, :-1] = scaler.transform(X[:, :-1])
-    metrics = model.evaluate(X, Y, sample_weight=W, verbose=0)
-
-    loss, acc = metrics
-
-    return loss
-
-
-def do_cv(X_even, Y_even, W_even, X_odd, Y_odd, W_odd, **kwargs):
-    # Cross validation loop
-    results = []
-    skf = StratifiedKFold(n_splits=5)
-    for X, Y, W in [(X_even, Y_even, W_even), (X_odd, Y_odd, W_odd)]:
-        # CV Loop
-        for train_idx, test_idx in skf.split(X, Y):
-            scaler, model = pnet.train(X[train_idx], Y[train_idx], W[train_idx], **kwargs)
-
-            # Test training
-            X_test, Y_test, W_test = X[test_idx], Y[test_idx], W[test_idx]
-            pnet.sample_bkg_mass(X_test[:, -1], Y_test)
-            results.append(evaluate(X_test, Y_test, W_test, scaler, model))
-
-    return np.mean(results)
+from hyperopt import hp, tpe, Trials, space_eval
+from hyperopt.base import Domain, spec_from_misc, JOB_STATE_DONE, STATUS_OK
+from keras.callbacks import Callback
+
+from parametricnet import ParametricNet
+from train import (add_loader_arguments, get_data_loader, cv_splits, dump_arrays,
+                   load_arrays, worker_pool)
+
+logging.getLogger().setLevel(logging.INFO)
+
+
+space = {
+    "learning_rate": hp.lognormal("lr", -2, 1),
+    "learning_rate_decay": hp.loguniform("lr_decay", np.log(1e-9), np.log(1e-4)),
+    "layer_number": hp.quniform("layer_number", 1, 4, 1),
+    "layer_size": 1 + hp.quniform("layer_size", 8, 128, 2)
+}
+
+
+class MedianStopping(Callback):
+    # Publishes the validation loss after every epoch in the curves shared
+    # between trials and stops the trial once its best validation loss is
+    # worse than the median of the best validation losses of all other
+    # (running or finished) trials at the same epoch
+    def __init__(self, curves, tid, grace_epochs):
+        # curves: dict proxy of trial id -> validation losses so far
+        super(MedianStopping, self).__init__()
+        self.curves = curves
+        self.tid = tid
+        self.grace_epochs = grace_epochs
+        self.curve = []
+
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.curve.append(logs["val_loss"])
+        self.curves[self.tid] = self.curve
+        if epoch + 1 < self.grace_epochs:
+            return
+
+        reference = [min(curve[:epoch + 1]) for tid, curve in self.curves.items()
+                     if tid != self.tid and len(curve) > epoch]
+        if reference and min(self.curve) > np.median(reference):
+            print("Pruning trial after epoch {}".format(epoch + 1))
+            self.model.stop_training = True
+
+
+def trial_task(task):
+    # Trains one network and returns its validation loss after every epoch
+    tid, params, args, data_dir, train_idx, val_idx, curves = task
+    X, Y, W = load_arrays(data_dir)
+
+    net = ParametricNet()
+    net.epochs = args.epochs
+    net.batch_size = args.batch_size
+    net.learning_rate = params["learning_rate"]
+    net.learning_rate_decay = params["learning_rate_decay"]
+    net.layer_size = [int(params["layer_size"])] * int(params["layer_number"])
+
+    history = net.train(X[train_idx], Y[train_idx], W[train_idx],
+                        validation_data=(X[val_idx], Y[val_idx], W[val_idx]),
+                        callbacks=[MedianStopping(curves, tid, args.grace_epochs)])
+
+    return history.history["val_loss"]
+
+
+def main(args):
+    data_loader = get_data_loader(args)
+    data_loader.fold = args.fold
+    X, Y, W = data_loader.load(args.ntuple)
+
+    # First CV split is used as training / validation set
+    train_idx, val_idx = cv_splits(X, args.cv)[0]
+    data_dir = dump_arrays(X, Y, W)
+
+    domain = Domain(lambda params: None, space)
+    trials = Trials()
+    rng = np.random.RandomState(args.seed)
+
+    # Fresh interpreters: the TensorFlow state of the parent is not fork-safe
+    context = multiprocessing.get_context("spawn")
+    manager = context.Manager()
+    pool = worker_pool(context, args.workers, args.threads)
+    try:
+        # Validation curves of all trials, updated by the workers after every epoch
+        curves = manager.dict()
+        # Trial id -> (trial, parameters, result) of the trials in flight
+        running = {}
+        finished = queue.Queue()
+
+        while running or len(trials.trials) < args.max_evals:
+            # A new trial is suggested whenever a worker is free, so that
+            # TPE sees the results of all trials finished so far
+            while len(running) < args.workers and len(trials.trials) < args.max_evals:
+                tid, = trials.new_trial_ids(1)
+                trials.insert_trial_docs(tpe.suggest([tid], domain, trials,
+                                                     rng.randint(2**31 - 1)))
+                trials.refresh()
+
+                trial = trials.trials[-1]
+                params = space_eval(space, spec_from_misc(trial["misc"]))
+                task = (tid, params, args, data_dir, train_idx, val_idx, curves)
+                result = pool.apply_async(trial_task, (task,),
+                                          callback=lambda _, tid=tid: finished.put(tid),
+                                          error_callback=lambda _, tid=tid: finished.put(tid))
+                running[tid] = (trial, params, result)
+
+            tid = finished.get()
+            trial, params, result = running.pop(tid)
+            curve = result.get()
+
+            trial["state"] = JOB_STATE_DONE
+            trial["result"] = {"loss": float(min(curve)), "status": STATUS_OK,
+                               "epochs": len(curve)}
+            trials.refresh()
+
+            logging.info("Trial {}: loss {:.5f} after {} epochs with {}".format(
+                tid, min(curve), len(curve), params))
+    finally:
+        pool.close()
+        pool.join()
+        manager.shutdown()
+        shutil.rmtree(data_dir)
+
+    best = trials.best_trial
+    print("Best trial (loss {:.5f}):".format(best["result"]["loss"]))
+    print(space_eval(space, spec_from_misc(best["misc"])))
 
 
 if __name__ == "__main__":
-    f = uproot.open("mva_ntup.root")
-
-    sig_df = pnet.get_sig_df(f)
-    bkg_df = pnet.get_bkg_df(f)
-
-    sig_df_even = pnet.apply_selection(sig_df, fold="even")
-    bkg_df_even = pnet.apply_selection(bkg_df, fold="even")
-
-    sig_df_odd = pnet.apply_selection(sig_df, fold="odd")
-    bkg_df_odd = pnet.apply_selection(bkg_df, fold="odd")
-
-    X_even, Y_even, W_even = pnet.prepare_inputs(sig_df_even, bkg_df_even)
-    X_odd, Y_odd, W_odd = pnet.prepare_inputs(sig_df_odd, bkg_df_odd)
-
-
-    space = {
-        "learning_rate": hp.lognormal("lr", -2, 1),
-        "learning_rate_decay": hp.loguniform("lr_decay", np.log(1e-9), np.log(1e-4)),
-        "layer_number": hp.quniform("layer_number", 1, 4, 1),
-        "layer_size": 1 + hp.quniform("layer_size", 8, 128, 2)
-    }
-
-
-    def objective(args):
-        print(args)
-        args["layer_number"] = int(args["layer_number"])
-        args["layer_size"] = int(args["layer_size"])
-
-        return do_cv(X_even, Y_even, W_even, X_odd, Y_odd, W_odd, epochs=100, **args)
-
-    best = fmin(objective, space, algo=tpe.suggest, max_evals=50)
-
-    print(best)
-
-
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ntuple", help="Ntuple with MVA trees")
+    parser.add_argument("--fold", choices=["even", "odd"], default="even")
+
+    # Optimization parameters
+    parser.add_argument("--max-evals", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of trials trained concurrently")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of threads per worker")
+    parser.add_argument("-e", "--epochs", type=int, default=100,
+                        help="Maximum number of epochs per trial")
+    parser.add_argument("--batch-size", default=64, type=int)
+    parser.add_argument("--grace-epochs", type=int, default=10,
+                        help="Number of epochs before a trial can be pruned")
+    parser.add_argument("--cv", type=int, default=5,
+                        help="Inverse of the fraction of events used for validation")
+    parser.add_argument("--seed", type=int, default=None)
+
+    # DataLoader parameters
+    add_loader_arguments(parser)
+
+    args = parser.parse_args()
+    main(args)
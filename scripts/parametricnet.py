@@ -1,24 +1,181 @@
+import csv
+import json
 import logging
+import resource
+import time
+from collections import OrderedDict
 
 import numpy as np
 
-from sklearn.utils import shuffle
 from sklearn.preprocessing import RobustScaler
+from sklearn.model_selection import train_test_split
 
 from keras.models import Model
 from keras.layers import Input, Dense
 from keras.optimizers import SGD
-from keras.callbacks import Callback
+from keras.callbacks import Callback, EarlyStopping
+from keras.utils import Sequence
 from keras import backend as K
 
 
+def limit_threads(n_threads):
+    # Restrict the number of threads used by the TensorFlow backend
+    import tensorflow as tf
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=n_threads,
+                            inter_op_parallelism_threads=n_threads)
+    K.set_session(tf.Session(config=config))
+
+
+def current_learning_rate(model):
+    lr = model.optimizer.lr
+    decay = model.optimizer.decay
+    iterations = model.optimizer.iterations
+    lr_with_decay = lr / (1. + decay * K.cast(iterations, K.dtype(decay)))
+    return float(K.eval(lr_with_decay))
+
+
 class LRPrinter(Callback):
     def on_epoch_begin(self, epoch, logs=None):
-        lr = self.model.optimizer.lr
-        decay = self.model.optimizer.decay
-        iterations = self.model.optimizer.iterations
-        lr_with_decay = lr / (1. + decay * K.cast(iterations, K.dtype(decay)))
-        print("Current learning rate: " + str(K.eval(lr_with_decay)))
+        print("Current learning rate: " + str(current_learning_rate(self.model)))
+
+
+class EpochReport(Callback):
+    # Records per epoch the wall time, the time spent on fitting and
+    # validation, the throughput, the peak RSS and the learning rate.
+    # shuffle_time is the time spent preparing the epoch (resampling and
+    # shuffling). With workers > 0 this runs in the Keras enqueuer thread and
+    # overlaps with fitting, so it is not part of epoch_time.
+    # Written as JSON if the filename ends with '.json', as CSV otherwise.
+    def __init__(self, filename, sequence):
+        super(EpochReport, self).__init__()
+        self.filename = filename
+        self.sequence = sequence
+        self.records = []
+
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.learning_rate = current_learning_rate(self.model)
+        self.epoch_start = time.time()
+        self.batch_end = self.epoch_start
+
+
+    def on_batch_end(self, batch, logs=None):
+        self.batch_end = time.time()
+
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_end = time.time()
+        fit_time = self.batch_end - self.epoch_start
+
+        record = OrderedDict([
+            ("epoch", epoch + 1),
+            ("epoch_time", epoch_end - self.epoch_start),
+            ("shuffle_time", self.sequence.shuffle_times[epoch]),
+            ("fit_time", fit_time),
+            ("eval_time", epoch_end - self.batch_end),
+            ("samples_per_second", len(self.sequence.Y) / fit_time if fit_time > 0 else 0.),
+            ("peak_rss_mb", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.),
+            ("learning_rate", self.learning_rate)
+        ])
+        for key, value in sorted((logs or {}).items()):
+            record[key] = float(value)
+
+        self.records.append(record)
+        self.write()
+
+
+    def write(self):
+        with open(self.filename, "w") as f:
+            if self.filename.endswith(".json"):
+                json.dump(self.records, f, indent=4)
+            else:
+                writer = csv.DictWriter(f, fieldnames=list(self.records[0].keys()))
+                writer.writeheader()
+                writer.writerows(self.records)
+
+
+class ParameterSampler:
+    # Resamples the parameter of background events from the signal parameters.
+    # Indices, mass points and buffers are set up once so that resampling
+    # does not allocate any memory.
+    # rng: numpy Generator, by default seeded from the global np.random state
+    # so that np.random.seed reproduces the sampling
+    def __init__(self, param, Y, rng=None):
+        self.bkg_idx = np.flatnonzero(Y == 0)
+        self.masspoints = np.unique(param[Y == 1])
+
+        if rng is None:
+            rng = np.random.default_rng(np.random.randint(2**32, dtype=np.uint64))
+        self.rng = rng
+        self.uniform = np.empty(len(self.bkg_idx))
+        self.choice = np.empty(len(self.bkg_idx), dtype=np.intp)
+        self.sampled = np.empty(len(self.bkg_idx), dtype=param.dtype)
+
+
+    def sample(self, param):
+        # Uniform choice of mass point: floor(u * n_masspoints)
+        self.rng.random(out=self.uniform)
+        self.uniform *= len(self.masspoints)
+        np.copyto(self.choice, self.uniform, casting="unsafe")
+        np.minimum(self.choice, len(self.masspoints) - 1, out=self.choice)
+
+        np.take(self.masspoints, self.choice, out=self.sampled)
+        param[self.bkg_idx] = self.sampled
+
+
+class BestWeights(Callback):
+    # Restores the weights of the epoch with the lowest validation loss
+    def __init__(self):
+        super(BestWeights, self).__init__()
+        self.best = np.inf
+        self.best_epoch = None
+        self.best_weights = None
+
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs["val_loss"] < self.best:
+            self.best = logs["val_loss"]
+            self.best_epoch = epoch
+            self.best_weights = self.model.get_weights()
+
+
+    def on_train_end(self, logs=None):
+        if self.best_weights is not None:
+            print("Restoring weights of epoch {}".format(self.best_epoch + 1))
+            self.model.set_weights(self.best_weights)
+
+
+class TrainingSequence(Sequence):
+    # Batches of (X, Y, W) in random order. The background parameter is
+    # resampled and the order reshuffled at the end of every epoch, so a
+    # single 'fit_generator' call covers all epochs without copying X.
+    def __init__(self, X, Y, W, batch_size):
+        self.X, self.Y, self.W = X, Y, W
+        self.batch_size = batch_size
+
+        self.sampler = ParameterSampler(X[:, -1], Y)
+        self.perm = np.arange(len(Y))
+
+        # Time spent preparing every epoch
+        self.shuffle_times = []
+        self.on_epoch_end()
+
+
+    def __len__(self):
+        return (len(self.Y) + self.batch_size - 1) // self.batch_size
+
+
+    def __getitem__(self, idx):
+        batch = self.perm[idx * self.batch_size:(idx + 1) * self.batch_size]
+        return self.X[batch], self.Y[batch], self.W[batch]
+
+
+    def on_epoch_end(self):
+        start = time.time()
+        self.sampler.sample(self.X[:, -1])
+        np.random.shuffle(self.perm)
+        self.shuffle_times.append(time.time() - start)
 
 
 class ParametricNet:
@@ -31,6 +188,22 @@ class ParametricNet:
         self.momentum = kwargs.setdefault("momentum", 0.9)
         self.nesterov = kwargs.setdefault("nesterov", True)
 
+        # Early stopping (disabled if patience is None). Stops if the validation
+        # loss did not improve for 'patience' epochs and restores the best weights.
+        # Without explicit validation data a fraction of the inputs is used.
+        self.patience = kwargs.setdefault("patience", None)
+        self.validation_fraction = kwargs.setdefault("validation_fraction", 0.2)
+
+        # File for the per-epoch timing report (disabled if None)
+        self.report = kwargs.setdefault("report", None)
+
+        # Input pipeline settings (number of batches prepared in advance)
+        self.max_queue_size = kwargs.setdefault("max_queue_size", 10)
+        self.workers = kwargs.setdefault("workers", 1)
+
+        # Batch size used for inference
+        self.predict_batch_size = kwargs.setdefault("predict_batch_size", 4096)
+
         # Architecture settings
         self.layer_size = kwargs.setdefault("layer_size", [32, 32, 32])
         self.activation = kwargs.setdefault("activation", "relu")
@@ -46,13 +219,29 @@ class ParametricNet:
         return Model(x, y)
 
 
-    def sample_parameter(self, param, Y):
-        masspoints = np.unique(param[Y == 1])
-        sampled_mass = np.random.choice(masspoints, size=np.count_nonzero(Y == 0))
-        param[Y == 0] = sampled_mass
+    def validation_set(self, X, Y, W):
+        # Scaled validation set. The background parameter is sampled once so
+        # that the validation loss is comparable between epochs.
+        X_val = self.scale(X)
+        ParameterSampler(X_val[:, -1], Y).sample(X_val[:, -1])
+        return X_val, Y, W
+
+
+    def train(self, X, Y, W, validation_data=None, callbacks=None):
+        # validation_data: optional (X, Y, W) in the same format as the inputs
+        # callbacks: additional Keras callbacks
+        callbacks = list(callbacks or [])
 
+        if self.patience is not None:
+            if validation_data is None:
+                # Stratified in the parameter (background is a separate class)
+                X, X_val, Y, Y_val, W, W_val = train_test_split(
+                    X, Y, W, test_size=self.validation_fraction, stratify=X[:, -1])
+                validation_data = (X_val, Y_val, W_val)
+
+            callbacks += [EarlyStopping(monitor="val_loss", patience=self.patience),
+                          BestWeights()]
 
-    def train(self, X, Y, W):
         # Apply preprocessing
         # Scale everything except for last column which is the parameter
         self.scaler = RobustScaler()
@@ -72,19 +261,35 @@ class ParametricNet:
 
         self.model.compile(optimizer=sgd, loss="binary_crossentropy", metrics=["accuracy"])
 
-        # Epoch loop
-        for epoch in range(self.epochs):
-            X, Y, W = shuffle(X, Y, W)
+        if validation_data is not None:
+            validation_data = self.validation_set(*validation_data)
+
+        # Shuffling and parameter sampling happen in the input pipeline
+        sequence = TrainingSequence(X, Y, W, self.batch_size)
+
+        if self.report is not None:
+            callbacks.append(EpochReport(self.report, sequence))
+
+        return self.model.fit_generator(sequence, epochs=self.epochs, verbose=2,
+                                        callbacks=[lr_printer] + callbacks,
+                                        validation_data=validation_data, shuffle=False,
+                                        max_queue_size=self.max_queue_size,
+                                        workers=self.workers, use_multiprocessing=False)
+
+
+    def scale(self, X):
+        # Copy of X with the scaling applied to all but the parameter
+        X_scaled = np.array(X, copy=True)
+        X_scaled[:, :-1] = self.scaler.transform(X[:, :-1])
+        return X_scaled
 
-            # Sample parameter
-            self.sample_parameter(X[:, -1], Y)
 
-            self.model.fit(X, Y, sample_weight=W, batch_size=self.batch_size,
-                           epochs=1, verbose=2, callbacks=[lr_printer])
+    def predict(self, X_scaled):
+        # Prediction on inputs that were already scaled with 'scale'
+        return self.model.predict(X_scaled, batch_size=self.predict_batch_size).ravel()
 
 
     def evaluate(self, X, param):
-        X_copy = np.copy(X)
-        X_copy[:, :-1] = self.scaler.transform(X[:, :-1])
+        X_copy = self.scale(X)
         X_copy[:, -1] = param
-        return self.model.predict(X_copy)
+        return self.model.predict(X_copy, batch_size=self.predict_batch_size)
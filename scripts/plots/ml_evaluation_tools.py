@@ -1,7 +1,13 @@
-from array import array
+import os
+import sys
 from math import sqrt, log
+
+import numpy as np
 import ROOT as R
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from roc import roc_from_histograms, auc
+
 
 backgrounds = [
     "Fake",
@@ -14,36 +20,24 @@ backgrounds = [
 ]
 
 
-def get_roc(sig, bkg):
-    h_sig = sig.Clone()
-    h_bkg = bkg.Clone()
-
-    # Normalize
-    n_bins = h_sig.GetNbinsX()
-    h_sig.Scale(1 / h_sig.Integral(0, n_bins + 1))
-    h_bkg.Scale(1 / h_bkg.Integral(0, n_bins + 1))
-
-    h_sig_cum = h_sig.GetCumulative(R.kFALSE)
-    h_bkg_cum = h_bkg.GetCumulative(R.kFALSE)
+def hist_contents(hist):
+    # Bin contents including underflow and overflow
+    return np.array([hist.GetBinContent(idx) for idx in range(hist.GetNbinsX() + 2)])
 
-    sig_effs = [1.0]
-    bkg_rejs = [0.0]
-    for bin_idx in range(1, n_bins + 1):
-        sig_effs.append(h_sig_cum.GetBinContent(bin_idx))
-        bkg_rejs.append(1.0 - h_bkg_cum.GetBinContent(bin_idx))
 
-    sig_effs.append(0)
-    bkg_rejs.append(1)
+def get_roc(sig, bkg):
+    sig_sumw = hist_contents(sig)
+    bkg_sumw = hist_contents(bkg)
 
-    sig_effs = array("f", sig_effs)
-    bkg_rejs = array("f", bkg_rejs)
+    # Normalized to the integral including under- and overflow
+    fpr, tpr = roc_from_histograms(sig_sumw[1:-1], bkg_sumw[1:-1],
+                                   sig_sumw.sum(), bkg_sumw.sum())
 
-    # Trapezoidal rule
-    deltas = [k - km1 for km1, k in zip(sig_effs[1:], sig_effs[:-1])]
-    sums = [k + km1 for k, km1 in zip(bkg_rejs[1:], bkg_rejs[:-1])]
-    integral = sum(s * d / 2.0 for s, d in zip(sums, deltas))
+    # Ordered by increasing cut value
+    sig_effs = np.ascontiguousarray(tpr[::-1])
+    bkg_rejs = np.ascontiguousarray(1.0 - fpr[::-1])
 
-    return R.TGraph(len(sig_effs), sig_effs, bkg_rejs), integral
+    return R.TGraph(len(sig_effs), sig_effs, bkg_rejs), auc(fpr, tpr)
 
 
 def asimov_significance(sig, bkg):
@@ -0,0 +1,87 @@
+import numpy as np
+
+
+def roc_curve(y_true, y_score, sample_weight=None):
+    # Weighted ROC curve with a single sort of the scores.
+    # Returns false positive rate, true positive rate and thresholds ordered
+    # by decreasing threshold (increasing rates).
+    y_true = np.asarray(y_true).ravel()
+    y_score = np.asarray(y_score).ravel()
+    # Weights are accumulated in double precision, float32 sums over
+    # millions of events lose the small tail contributions
+    if sample_weight is None:
+        sample_weight = np.ones(len(y_score))
+    sample_weight = np.asarray(sample_weight, dtype=np.float64).ravel()
+
+    order = np.argsort(y_score, kind="mergesort")[::-1]
+    score = y_score[order]
+    is_sig = y_true[order] == 1
+    weight = sample_weight[order]
+
+    # Last position of every distinct score
+    threshold_idx = np.r_[np.flatnonzero(np.diff(score)), len(score) - 1]
+
+    tps = np.r_[0., np.cumsum(np.where(is_sig, weight, 0.))[threshold_idx]]
+    fps = np.r_[0., np.cumsum(np.where(is_sig, 0., weight))[threshold_idx]]
+    thresholds = np.r_[np.inf, score[threshold_idx]]
+
+    return fps / fps[-1], tps / tps[-1], thresholds
+
+
+def roc_from_histograms(sig_sumw, bkg_sumw, sig_total=None, bkg_total=None):
+    # ROC curve from binned scores (bins in increasing order of the score).
+    # The totals used for normalisation default to the sum over all bins.
+    sig_sumw = np.asarray(sig_sumw, dtype=float)
+    bkg_sumw = np.asarray(bkg_sumw, dtype=float)
+    if sig_total is None:
+        sig_total = sig_sumw.sum()
+    if bkg_total is None:
+        bkg_total = bkg_sumw.sum()
+
+    # Efficiencies for cuts at the lower edge of every bin, starting from the top
+    tpr = np.r_[0., np.cumsum(sig_sumw[::-1]) / sig_total, 1.]
+    fpr = np.r_[0., np.cumsum(bkg_sumw[::-1]) / bkg_total, 1.]
+
+    return fpr, tpr
+
+
+def histogram_roc_curve(y_true, y_score, sample_weight=None, bins=10000, score_range=(0., 1.)):
+    # Approximate ROC curve without sorting for very large samples
+    y_true = np.asarray(y_true).ravel()
+    y_score = np.asarray(y_score).ravel()
+    if sample_weight is None:
+        sample_weight = np.ones(len(y_score))
+    sample_weight = np.asarray(sample_weight, dtype=np.float64).ravel()
+
+    low, high = score_range
+    bin_idx = ((y_score - low) * (bins / (high - low))).astype(np.intp)
+    np.clip(bin_idx, 0, bins - 1, out=bin_idx)
+
+    is_sig = y_true == 1
+    sig_weight = np.where(is_sig, sample_weight, 0.).astype(np.float64, copy=False)
+    bkg_weight = np.where(is_sig, 0., sample_weight).astype(np.float64, copy=False)
+    sig_sumw = np.bincount(bin_idx, weights=sig_weight, minlength=bins)
+    bkg_sumw = np.bincount(bin_idx, weights=bkg_weight, minlength=bins)
+
+    return roc_from_histograms(sig_sumw, bkg_sumw)
+
+
+def auc(fpr, tpr):
+    # Trapezoidal rule
+    return np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1])) / 2.
+
+
+def working_points(fpr, tpr, sig_effs):
+    # False positive rates at the requested signal efficiencies
+    return np.interp(sig_effs, tpr, fpr)
+
+
+def roc_summary(y_true, y_score, sample_weight=None, sig_effs=(), bins=None):
+    # AUC and false positive rates at the requested signal efficiencies.
+    # Uses the histogram approximation if 'bins' is given.
+    if bins is None:
+        fpr, tpr, _ = roc_curve(y_true, y_score, sample_weight)
+    else:
+        fpr, tpr = histogram_roc_curve(y_true, y_score, sample_weight, bins)
+
+    return auc(fpr, tpr), working_points(fpr, tpr, sig_effs)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+import uproot
+
+from compile_net import dense_stack, activation, activate
+
+logging.getLogger().setLevel(logging.INFO)
+
+
+# Mass grid of the detuning studies
+DEFAULT_MASSES = sorted([251, 325] + list(range(250, 1001, 2)))
+
+# Keras activation names in the lwtnn convention
+KERAS_ACTIVATIONS = {"relu": "rectified", "sigmoid": "sigmoid", "tanh": "tanh",
+                     "linear": "linear", "elu": "elu", "hard_sigmoid": "hard_sigmoid"}
+
+
+class DenseNetwork(object):
+    # NumPy evaluation of a parametrised stack of dense layers. The input
+    # scaling is folded into the first layer and the mass column of the
+    # first layer is kept apart, so that the rest of the first layer is
+    # computed once per event for all masses.
+    def __init__(self, variables, offsets, scales, layers, parameter="mass"):
+        # variables, offsets, scales: inputs in the lwtnn convention, (x + offset) * scale
+        # layers: list of (weights [n_inputs x n_outputs], bias, activation, alpha)
+        offsets = np.asarray(offsets, dtype=np.float64)
+        scales = np.asarray(scales, dtype=np.float64)
+
+        weights, bias, function, alpha = layers[0]
+        weights = weights * scales[:, np.newaxis]
+        bias = bias + offsets.dot(weights)
+
+        param_idx = variables.index(parameter)
+        self.variables = [var for var in variables if var != parameter]
+        self.parameter_weights = weights[param_idx].astype(np.float32)
+        self.first_layer = (np.delete(weights, param_idx, axis=0), bias, function, alpha)
+
+        # Remaining layers in single precision like the training
+        self.layers = [(w.astype(np.float32), b.astype(np.float32), f, a)
+                       for w, b, f, a in layers[1:]]
+
+
+    @classmethod
+    def from_lwtnn(cls, spec_file, output_layer="output_layer"):
+        # Network filled with fill_spec.py and converted by kerasfunc2json.py
+        with open(spec_file) as f_spec:
+            spec = json.load(f_spec)
+
+        inputs, layers = dense_stack(spec, output_layer)
+        n_inputs = len(inputs["variables"])
+        dense_layers = []
+        for layer in layers:
+            bias = np.array(layer["bias"], dtype=np.float64)
+            weights = np.array(layer["weights"], dtype=np.float64).reshape(len(bias), n_inputs).T
+            dense_layers.append((weights, bias) + activation(layer))
+            n_inputs = len(bias)
+
+        return cls([var["name"] for var in inputs["variables"]],
+                   [var["offset"] for var in inputs["variables"]],
+                   [var["scale"] for var in inputs["variables"]],
+                   dense_layers)
+
+
+    @classmethod
+    def from_keras(cls, model_file, scaler_file):
+        # model.h5 and scaler.json written by train.py
+        from keras.models import load_model
+
+        with open(scaler_file) as f_scaler:
+            scaler = json.load(f_scaler)
+
+        layers = []
+        for layer in load_model(model_file, compile=False).layers:
+            if layer.__class__.__name__ == "InputLayer":
+                continue
+            if layer.__class__.__name__ != "Dense":
+                raise ValueError("Only dense layers are supported, got " + layer.name)
+
+            weights, bias = layer.get_weights()
+            function = KERAS_ACTIVATIONS[layer.get_config()["activation"]]
+            layers.append((weights.astype(np.float64), bias.astype(np.float64), function, 1.))
+
+        return cls(scaler["input_vars"],
+                   -np.array(scaler["center"]), 1. / np.array(scaler["scale"]),
+                   layers)
+
+
+    def precompute(self, X):
+        # Mass-independent part of the first layer, X holds the unscaled
+        # inputs in the order of 'variables'
+        weights, bias, _, _ = self.first_layer
+        return (np.asarray(X, dtype=np.float64).dot(weights) + bias).astype(np.float32)
+
+
+    def predict(self, first_layer, mass):
+        # Scores for one mass given the output of 'precompute'
+        _, _, function, alpha = self.first_layer
+        x = activate(first_layer + np.float32(mass) * self.parameter_weights, function, alpha)
+        for weights, bias, function, alpha in self.layers:
+            x = x.dot(weights)
+            x += bias
+            activate(x, function, alpha)
+        return x[:, 0]
+
+
+def load_network(model_file, scaler_file=None):
+    if model_file.endswith(".json"):
+        return DenseNetwork.from_lwtnn(model_file)
+    if scaler_file is None:
+        raise ValueError("Keras model {} needs a scaler".format(model_file))
+    return DenseNetwork.from_keras(model_file, scaler_file)
+
+
+class Histograms(object):
+    # Weighted histograms of the scores of every mass with under- and
+    # overflow bins (ROOT convention)
+    def __init__(self, n_masses, bins, score_range):
+        self.bins = bins
+        self.low, self.high = score_range
+        self.sumw = np.zeros((n_masses, bins + 2))
+        self.sumw2 = np.zeros((n_masses, bins + 2))
+
+
+    def fill(self, mass_idx, scores, weights):
+        idx = np.floor((scores - self.low) * (self.bins / (self.high - self.low))).astype(np.intp)
+        np.clip(idx + 1, 0, self.bins + 1, out=idx)
+        self.sumw[mass_idx] += np.bincount(idx, weights=weights, minlength=self.bins + 2)
+        self.sumw2[mass_idx] += np.bincount(idx, weights=weights**2, minlength=self.bins + 2)
+
+
+def score_tree(tree, networks, masses, args, histograms=None, scores_file=None):
+    # networks: (network applied to even events, network applied to odd events)
+    variables = networks[0].variables
+    branches = list(set(variables + [args.event_number_variable, args.weight_name]))
+    if scores_file is not None:
+        scores_out = np.lib.format.open_memmap(scores_file, mode="w+", dtype=np.float32,
+                                               shape=(len(masses), tree.numentries))
+
+    start = 0
+    for arrays in tree.iterate(branches, entrysteps=args.chunk_size, namedecode="utf-8"):
+        n_events = len(arrays[args.event_number_variable])
+        X = np.column_stack([arrays[var] for var in variables])
+        weights = np.asarray(arrays[args.weight_name], dtype=np.float64)
+
+        # Events are scored with the network trained on the other fold
+        is_even = arrays[args.event_number_variable] % 2 == 0
+        folds = [(net, np.flatnonzero(mask)) for net, mask in zip(networks, [is_even, ~is_even])]
+        folds = [(net, idx, net.precompute(X[idx])) for net, idx in folds if len(idx)]
+
+        scores = np.empty(n_events, dtype=np.float32)
+        for mass_idx, mass in enumerate(masses):
+            for net, idx, first_layer in folds:
+                scores[idx] = net.predict(first_layer, mass)
+
+            if histograms is not None:
+                histograms.fill(mass_idx, scores, weights)
+            if scores_file is not None:
+                scores_out[mass_idx, start:start + n_events] = scores
+
+        start += n_events
+
+    if scores_file is not None:
+        scores_out.flush()
+
+
+def write_histograms(filename, histograms, masses, name_pattern):
+    import ROOT as R
+
+    f = R.TFile.Open(filename, "RECREATE")
+    for tree, hists in sorted(histograms.items()):
+        for mass_idx, mass in enumerate(masses):
+            name = name_pattern.format(tree=tree, mass=mass)
+            h = R.TH1F(name, name, hists.bins, hists.low, hists.high)
+            h.Sumw2()
+            for idx in range(hists.bins + 2):
+                h.SetBinContent(idx, hists.sumw[mass_idx, idx])
+                h.SetBinError(idx, np.sqrt(hists.sumw2[mass_idx, idx]))
+            h.Write()
+    f.Close()
+
+
+def main(args):
+    if not args.scores_dir and not args.hist_output:
+        raise ValueError("Nothing to do: specify --scores-dir and / or --hist-output")
+
+    scalers = args.scalers or [None] * len(args.models)
+    networks = [load_network(model, scaler) for model, scaler in zip(args.models, scalers)]
+    if len(networks) == 1:
+        networks *= 2
+    else:
+        # The first model was trained on even event numbers and is applied to odd events
+        networks = networks[::-1]
+
+    if networks[0].variables != networks[1].variables:
+        raise ValueError("Networks of both folds need the same inputs")
+
+    masses = [int(m) if float(m).is_integer() else m for m in args.masses]
+
+    f = uproot.open(args.ntuple)
+    trees = args.trees or sorted(set(name.decode().split(";")[0] for name, cls in f.classes()
+                                     if cls.__name__ == "TTree"))
+
+    if args.scores_dir:
+        if not os.path.isdir(args.scores_dir):
+            os.makedirs(args.scores_dir)
+        np.save(os.path.join(args.scores_dir, "masses.npy"), np.array(args.masses))
+
+    histograms = {}
+    for tree in trees:
+        logging.info("Scoring {} at {} masses".format(tree, len(masses)))
+        if args.hist_output:
+            histograms[tree] = Histograms(len(masses), args.bins, args.hist_range)
+        scores_file = os.path.join(args.scores_dir, tree + ".npy") if args.scores_dir else None
+
+        score_tree(f[tree], networks, masses, args, histograms.get(tree), scores_file)
+
+    if args.hist_output:
+        logging.info("Writing histograms to " + args.hist_output)
+        write_histograms(args.hist_output, histograms, masses, args.hist_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ntuple")
+    parser.add_argument("--models", nargs="+", required=True,
+                        help="lwtnn JSON or Keras model(s). With two models the first is the one "
+                             "trained on even, the second on odd event numbers.")
+    parser.add_argument("--scalers", nargs="+", default=None,
+                        help="scaler.json of every Keras model")
+    parser.add_argument("--trees", nargs="+", default=None,
+                        help="Trees to score (default: all trees in the ntuple)")
+    parser.add_argument("--masses", nargs="+", type=float, default=DEFAULT_MASSES)
+    parser.add_argument("--chunk-size", type=int, default=100000,
+                        help="Number of events read and scored at once")
+    parser.add_argument("--weight-name", default="weight")
+    parser.add_argument("--event-number-variable", default="event_number")
+
+    # Outputs
+    parser.add_argument("--scores-dir", default=None,
+                        help="Write the scores of every tree as <tree>.npy (masses x events)")
+    parser.add_argument("--hist-output", default=None,
+                        help="ROOT file for weighted histograms of the scores")
+    parser.add_argument("--hist-name", default="{tree}_PNN{mass}",
+                        help="Name pattern of the histograms")
+    parser.add_argument("--bins", type=int, default=1000)
+    parser.add_argument("--hist-range", type=float, nargs=2, default=[0., 1.])
+
+    args = parser.parse_args()
+    main(args)
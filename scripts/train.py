@@ -2,92 +2,176 @@
 import argparse
 import json
 import logging
-import sys
+import multiprocessing
+import os
+import shutil
+import tempfile
 
 import numpy as np
 import pandas as pd
 
 from dataloader import DataLoader
-from parametricnet import ParametricNet
+from parametricnet import ParametricNet, limit_threads
 from evaluation import evaluate
 from sklearn.model_selection import StratifiedKFold
 
 logging.getLogger().setLevel(logging.INFO)
 
 
-def main(args):
-    # Load inputs & preprocess
-    data_loader = DataLoader(fold=args.fold)
-    data_loader.sig_tree_regex = args.sig_tree_regex
-    data_loader.bkg_trees = args.bkg_trees
-    data_loader.input_vars = args.input_vars
-    data_loader.weight_name = args.weight_name
-    data_loader.event_number_variable = args.event_number_variable
+def get_net(args, name=""):
+    # name: identifies the training in the file name of the epoch report
+    net = ParametricNet()
+    net.epochs = args.epochs
+    net.batch_size = args.batch_size
+    net.learning_rate = args.learning_rate
+    net.learning_rate_decay = args.learning_rate_decay
+    net.layer_size = args.layer_size
+    net.patience = args.patience
+    net.validation_fraction = args.validation_fraction
+    if args.report_dir:
+        net.report = os.path.join(args.report_dir, "report{}.csv".format(name))
+    return net
 
-    X, Y, W = data_loader.load(args.ntuple)
 
-    # K-fold cross validation loop
-    if args.cv:
-        results = []
+def cv_split(args, data_loader, X, Y, W, train_idx, test_idx, name=""):
+    net = get_net(args, name)
 
-        print("Total background: " + repr(W[Y == 0].sum()))
-        print("Total signal: " + repr(W[Y == 1].sum()))
+    X_train, Y_train, W_train = X[train_idx], Y[train_idx], W[train_idx]
+    net.train(X_train, Y_train, W_train)
 
-        # K-fold over truth-mass to get similar distributions in every split
-        skf = StratifiedKFold(n_splits=args.cv)
-        _, target = np.unique(X[:, -1], return_inverse=True)
-        for train_idx, test_idx in skf.split(np.zeros_like(target), target):
-            net = ParametricNet()
-            net.epochs = args.epochs
-            net.batch_size = args.batch_size
-            net.learning_rate = args.learning_rate
-            net.learning_rate_decay = args.learning_rate_decay
-            net.layer_size = args.layer_size
+    X_test, Y_test, W_test = X[test_idx], Y[test_idx], W[test_idx]
+    return evaluate(X_test, Y_test, W_test, data_loader, net)
 
-            X_train, Y_train, W_train = X[train_idx], Y[train_idx], W[train_idx]
-            net.train(X_train, Y_train, W_train)
 
-            X_test, Y_test, W_test = X[test_idx], Y[test_idx], W[test_idx]
-            results.append(evaluate(X_test, Y_test, W_test, data_loader, net))
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]
 
-        pd.DataFrame(results).to_csv("cv_results_{}.csv".format(args.fold))
-        sys.exit(0)
 
+def worker_pool(context, processes, threads):
+    # Pool of spawned workers restricted to a few cores each. The OpenMP / BLAS
+    # runtimes read the thread variables when they are loaded, which happens
+    # while the worker imports this module, so they have to be inherited from
+    # the parent environment.
+    saved = {var: os.environ.get(var) for var in THREAD_VARIABLES}
+    try:
+        for var in THREAD_VARIABLES:
+            os.environ[var] = str(threads)
+        return context.Pool(processes, initializer=init_cv_worker, initargs=(threads,))
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = value
 
-    # Training
-    net = ParametricNet()
-    net.epochs = args.epochs
-    net.batch_size = args.batch_size
-    net.learning_rate = args.learning_rate
-    net.learning_rate_decay = args.learning_rate_decay
-    net.layer_size = args.layer_size
 
+def init_cv_worker(threads):
+    # TensorFlow thread pools are configured per session
+    limit_threads(threads)
+
+
+def load_arrays(data_dir):
+    # The training arrays are memory-mapped instead of being pickled
+    return [np.load(os.path.join(data_dir, name + ".npy"), mmap_mode="r")
+            for name in ["X", "Y", "W"]]
+
+
+def cv_split_task(task):
+    args, data_loader, data_dir, train_idx, test_idx, name = task
+    X, Y, W = load_arrays(data_dir)
+
+    return cv_split(args, data_loader, X, Y, W, train_idx, test_idx, name)
+
+
+def dump_arrays(X, Y, W):
+    # Temporary directory with the arrays to be memory-mapped by workers
+    data_dir = tempfile.mkdtemp(prefix="pnet_cv_")
+    for name, arr in [("X", X), ("Y", Y), ("W", W)]:
+        np.save(os.path.join(data_dir, name + ".npy"), arr)
+
+    return data_dir
+
+
+def cross_validate_parallel(args, data_loader, fold, X, Y, W, splits):
+    data_dir = dump_arrays(X, Y, W)
+    try:
+        logging.info("Running {} CV splits with {} workers".format(len(splits), args.cv_workers))
+
+        # Fresh interpreters: the TensorFlow state of the parent is not fork-safe
+        context = multiprocessing.get_context("spawn")
+        pool = worker_pool(context, args.cv_workers, args.cv_threads)
+        try:
+            tasks = [(args, data_loader, data_dir, train_idx, test_idx,
+                      "_{}_cv{}".format(fold, i))
+                     for i, (train_idx, test_idx) in enumerate(splits)]
+            return pool.map(cv_split_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def cv_splits(X, n_splits):
+    # K-fold over truth-mass to get similar distributions in every split
+    skf = StratifiedKFold(n_splits=n_splits)
+    _, target = np.unique(X[:, -1], return_inverse=True)
+    return list(skf.split(np.zeros_like(target), target))
+
+
+def cross_validate(args, data_loader, fold, X, Y, W):
+    print("Total background: " + repr(W[Y == 0].sum()))
+    print("Total signal: " + repr(W[Y == 1].sum()))
+
+    splits = cv_splits(X, args.cv)
+
+    if args.cv_workers > 1:
+        results = cross_validate_parallel(args, data_loader, fold, X, Y, W, splits)
+    else:
+        results = [cv_split(args, data_loader, X, Y, W, train_idx, test_idx,
+                            "_{}_cv{}".format(fold, i))
+                   for i, (train_idx, test_idx) in enumerate(splits)]
+
+    pd.DataFrame(results).to_csv("cv_results_{}.csv".format(fold))
+
+
+def train(args, data_loader, X, Y, W, suffix=""):
+    net = get_net(args, suffix)
     net.train(X, Y, W)
 
     # Save outputs
-    scaler_out = "scaler.json"
+    scaler_out = "scaler{}.json".format(suffix)
     logging.info("Saving scaling factors in " + scaler_out)
 
     # Fill variable names & scaling factors into json
     outputs = {
         "input_vars": data_loader.input_vars + ["mass"],
-        "center": list(net.scaler.center_) + [data_loader.mass_min],
-        "scale": list(net.scaler.scale_) + [data_loader.mass_max - data_loader.mass_min]
+        "center": [float(c) for c in net.scaler.center_] + [data_loader.mass_min],
+        "scale": [float(s) for s in net.scaler.scale_] + [data_loader.mass_max - data_loader.mass_min]
     }
 
     with open(scaler_out, "w") as outf:
         json.dump(outputs, outf, indent=4)
 
-    model_out = "model.h5"
+    model_out = "model{}.h5".format(suffix)
     logging.info("Saving network weights in " + model_out)
     net.model.save(model_out)
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("ntuple", help="Ntuple with MVA trees")
+def get_data_loader(args):
+    data_loader = DataLoader()
+    data_loader.sig_tree_regex = args.sig_tree_regex
+    data_loader.bkg_trees = args.bkg_trees
+    data_loader.input_vars = args.input_vars
+    data_loader.weight_name = args.weight_name
+    data_loader.event_number_variable = args.event_number_variable
+    data_loader.cache_dir = args.cache_dir
+    data_loader.loader_workers = args.loader_workers
+    data_loader.loader_pool = args.loader_pool
+    data_loader.compact = args.compact
+    return data_loader
 
-    # DataLoader parameters
+
+def add_loader_arguments(parser):
     parser.add_argument("--sig-tree-regex", default=r"(Xtohh(\d+))")
     parser.add_argument("--bkg-trees", nargs="+",
                         default=["ttbar", "ttbarFakesMC", "Ztautau", "Fake", "VH",
@@ -96,7 +180,50 @@ if __name__ == "__main__":
                         default=["dRTauTau", "dRBB", "mMMC", "mBB", "mHH"])
     parser.add_argument("--weight-name", default="weight")
     parser.add_argument("--event-number-variable", default="event_number")
-    parser.add_argument("--fold", choices=["even", "odd"], required=True)
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directory to cache the preprocessed inputs in")
+    parser.add_argument("--loader-workers", default=1, type=int,
+                        help="Number of trees read concurrently")
+    parser.add_argument("--loader-pool", choices=["thread", "process"], default="thread")
+    parser.add_argument("--compact", action="store_true",
+                        help="Keep inputs and weights as float32 and labels as int8")
+
+
+def main(args):
+    # Load inputs & preprocess
+    data_loader = get_data_loader(args)
+
+    if args.report_dir and not os.path.isdir(args.report_dir):
+        os.makedirs(args.report_dir)
+
+    # Both folds are read from the ntuple in a single pass
+    if args.fold == "both":
+        datasets = data_loader.load_folds(args.ntuple)
+    else:
+        data_loader.fold = args.fold
+        datasets = {args.fold: data_loader.load(args.ntuple)}
+
+    for fold in sorted(datasets):
+        X, Y, W = datasets[fold]
+
+        # K-fold cross validation loop
+        if args.cv:
+            cross_validate(args, data_loader, fold, X, Y, W)
+            continue
+
+        # Training (outputs get a fold suffix if both folds are trained)
+        train(args, data_loader, X, Y, W,
+              suffix="_" + fold if args.fold == "both" else "")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ntuple", help="Ntuple with MVA trees")
+
+    # DataLoader parameters
+    add_loader_arguments(parser)
+    parser.add_argument("--fold", choices=["even", "odd", "both"], required=True,
+                        help="Fold to train on ('both' trains both folds from a single read)")
 
     # ParametricNet parameters
     parser.add_argument("-e", "--epochs", default=100, type=int)
@@ -105,9 +232,19 @@ if __name__ == "__main__":
     parser.add_argument("--learning-rate-decay", default=1e-5, type=float)
     parser.add_argument("-l", "--layer-size", default=[32, 32, 32], nargs="+",
                         type=int, help="List of hidden layer sizes")
+    parser.add_argument("--patience", default=None, type=int,
+                        help="Enable early stopping with this patience (in epochs)")
+    parser.add_argument("--validation-fraction", default=0.2, type=float,
+                        help="Fraction of the training data used to monitor early stopping")
+    parser.add_argument("--report-dir", default=None,
+                        help="Directory for per-epoch timing and throughput reports")
 
     # Cross validation
     parser.add_argument("--cv", type=int, default=None)
+    parser.add_argument("--cv-workers", type=int, default=1,
+                        help="Number of CV splits trained concurrently")
+    parser.add_argument("--cv-threads", type=int, default=1,
+                        help="Number of threads per CV worker")
 
     args = parser.parse_args()
     main(args)
@@ -1,78 +1,153 @@
 #!/usr/bin/env python
 import argparse
+import logging
+import multiprocessing
+import os
 import random
-import subprocess
-import sys
+import shutil
 
-parser = argparse.ArgumentParser()
-parser.add_argument("seed", type=int)
-parser.add_argument("ntup")
-args = parser.parse_args()
+import pandas as pd
 
-random.seed(args.seed)
+from train import (add_loader_arguments, get_data_loader, cv_splits, dump_arrays,
+                   worker_pool, cv_split_task)
 
-epochs = random.choice([50, 100, 200, 400])
-batch_size = random.choice([64, 128, 256])
-learning_rate = random.choice([0.01, 0.02, 0.05, 0.1, 0.2])
-learning_rate_decay = random.choice([1e-6, 1e-5, 1e-4, 1e-3])
+logging.getLogger().setLevel(logging.INFO)
 
-n_layers = random.randint(1, 5)
 
-# Possible layer sizes
-layer_sizes = [16, 32, 64, 128]
+def sample_hyperparameters(seed):
+    random.seed(seed)
 
-# Some code to generate reasonable layouts
-top_layer = random.choice(layer_sizes)
-mid_layer = random.choice(layer_sizes)
-bot_layer = random.choice(layer_sizes)
+    epochs = random.choice([50, 100, 200, 400])
+    batch_size = random.choice([64, 128, 256])
+    learning_rate = random.choice([0.01, 0.02, 0.05, 0.1, 0.2])
+    learning_rate_decay = random.choice([1e-6, 1e-5, 1e-4, 1e-3])
 
-while top_layer > mid_layer:
-    top_layer = random.choice(layer_sizes)
+    n_layers = random.randint(1, 5)
+
+    # Possible layer sizes
+    layer_sizes = [16, 32, 64, 128]
 
-while bot_layer > mid_layer:
+    # Some code to generate reasonable layouts
+    top_layer = random.choice(layer_sizes)
+    mid_layer = random.choice(layer_sizes)
     bot_layer = random.choice(layer_sizes)
 
-layers = []
-for i in range(n_layers):
-    if i == 0:
-        layers.append(top_layer)
-    elif i == n_layers - 1:
-        layers.append(bot_layer)
-    else:
-        layers.append(mid_layer)
-
-layers = [str(l) for l in layers]
-
-arglist = []
-arglist += ["-e", str(epochs)]
-arglist += ["--batch-size", str(batch_size)]
-arglist += ["--learning-rate", str(learning_rate)]
-arglist += ["--learning-rate-decay", str(learning_rate_decay)]
-arglist += ["--layer-size"] + layers
-
-
-# Even-fold
-with open("train_even.log", "w") as f:
-    f.write("Arguments: " + repr(arglist) + "\n")
-    f.flush()
-    train_even = subprocess.Popen(["train.py", args.ntup,
-                                   "--fold", "even",
-                                   "--cv", "5"]
-                                  + arglist,
-                                  stdout=f)
-    train_even.communicate()
-    if train_even.returncode:
-        sys.exit(train_even.returncode)
-
-# Odd-fold
-with open("train_odd.log", "w") as f:
-    f.write("Arguments: " + repr(arglist) + "\n")
-    f.flush()
-    train_odd = subprocess.Popen(["train.py", args.ntup,
-                                   "--fold", "odd",
-                                  "--cv", "5"]
-                                  + arglist,
-                                  stdout=f)
-    train_odd.communicate()
-    if train_odd.returncode:
-        sys.exit(train_odd.returncode)
+    while top_layer > mid_layer:
+        top_layer = random.choice(layer_sizes)
+
+    while bot_layer > mid_layer:
+        bot_layer = random.choice(layer_sizes)
+
+    layers = []
+    for i in range(n_layers):
+        if i == 0:
+            layers.append(top_layer)
+        elif i == n_layers - 1:
+            layers.append(bot_layer)
+        else:
+            layers.append(mid_layer)
+
+    return argparse.Namespace(epochs=epochs, batch_size=batch_size,
+                              learning_rate=learning_rate,
+                              learning_rate_decay=learning_rate_decay,
+                              layer_size=layers)
+
+
+def scan_task(job):
+    # Trains and evaluates one (seed, fold, cv-split) job
+    seed, fold, split, task = job
+    return seed, fold, split, cv_split_task(task)
+
+
+def completed_jobs(results_file):
+    if not os.path.exists(results_file):
+        return set()
+
+    df = pd.read_csv(results_file)
+    return set(zip(df.seed, df.fold, df.split))
+
+
+def main(args):
+    done = completed_jobs(args.output)
+
+    if args.report_dir and not os.path.isdir(args.report_dir):
+        os.makedirs(args.report_dir)
+
+    # Both folds are read once and shared with the workers as memory maps
+    data_loader = get_data_loader(args)
+    datasets = data_loader.load_folds(args.ntup)
+
+    data_dirs = {}
+    jobs = []
+    try:
+        for fold in sorted(datasets):
+            X, Y, W = datasets[fold]
+            splits = cv_splits(X, args.cv)
+            data_dirs[fold] = dump_arrays(X, Y, W)
+
+            for seed in range(args.seeds[0], args.seeds[1]):
+                hparams = sample_hyperparameters(seed)
+                hparams.patience = args.patience
+                hparams.validation_fraction = args.validation_fraction
+                hparams.report_dir = args.report_dir
+                for split, (train_idx, test_idx) in enumerate(splits):
+                    if (seed, fold, split) in done:
+                        continue
+
+                    task = (hparams, data_loader, data_dirs[fold], train_idx, test_idx,
+                            "_seed{}_{}_cv{}".format(seed, fold, split))
+                    jobs.append((seed, fold, split, task))
+
+        logging.info("Skipping {} completed jobs, running {} jobs with {} workers".format(
+            len(done), len(jobs), args.workers))
+
+        # Fresh interpreters: the TensorFlow state of the parent is not fork-safe
+        context = multiprocessing.get_context("spawn")
+        pool = worker_pool(context, args.workers, args.threads)
+        try:
+            for seed, fold, split, metrics in pool.imap_unordered(scan_task, jobs):
+                hparams = sample_hyperparameters(seed)
+                row = {"seed": seed, "fold": fold, "split": split,
+                       "epochs": hparams.epochs, "batch_size": hparams.batch_size,
+                       "learning_rate": hparams.learning_rate,
+                       "learning_rate_decay": hparams.learning_rate_decay,
+                       "layer_size": " ".join(str(l) for l in hparams.layer_size)}
+                row.update(metrics)
+
+                # Results are appended as they arrive so that an interrupted
+                # scan can be resumed
+                pd.DataFrame([row]).to_csv(args.output, mode="a", index=False,
+                                           header=not os.path.exists(args.output))
+                logging.info("Finished seed {} fold {} split {}".format(seed, fold, split))
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        for data_dir in data_dirs.values():
+            shutil.rmtree(data_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ntup")
+    parser.add_argument("--seeds", nargs=2, type=int, required=True,
+                        metavar=("FIRST", "STOP"), help="Range of seeds to scan")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of jobs trained concurrently")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of threads per worker")
+    parser.add_argument("--cv", type=int, default=5)
+    parser.add_argument("--patience", default=None, type=int,
+                        help="Enable early stopping with this patience (in epochs)")
+    parser.add_argument("--validation-fraction", default=0.2, type=float,
+                        help="Fraction of the training data used to monitor early stopping")
+    parser.add_argument("--report-dir", default=None,
+                        help="Directory for per-epoch timing and throughput reports")
+    parser.add_argument("-o", "--output", default="scan_results.csv",
+                        help="Table collecting the results of all jobs")
+
+    # DataLoader parameters
+    add_loader_arguments(parser)
+
+    args = parser.parse_args()
+    main(args)
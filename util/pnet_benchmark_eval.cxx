@@ -0,0 +1,144 @@
+// Compares the evaluation time of the generic lwtnn graph and the native
+// dense evaluation of ParametricNet on random events at a grid of masses
+//
+// Usage: pnet_benchmark_eval even.json odd.json [n_events]
+
+#include <algorithm>
+#include <chrono>
+#include <cmath>
+#include <cstdio>
+#include <cstdlib>
+#include <fstream>
+#include <functional>
+#include <random>
+#include <string>
+#include <vector>
+
+#include "lwtnn/LightweightGraph.hh"
+#include "lwtnn/parse_json.hh"
+
+#include "ParametricNet/ParametricNet.h"
+
+
+namespace {
+
+  double time_ms(const std::function<void()> &func) {
+    const auto start = std::chrono::steady_clock::now();
+    func();
+    const std::chrono::duration<double, std::milli> elapsed =
+      std::chrono::steady_clock::now() - start;
+    return elapsed.count();
+  }
+
+  double max_difference(const std::vector<float> &a, const std::vector<float> &b) {
+    double result = 0.0;
+    for (size_t i = 0; i < a.size(); ++i) {
+      result = std::max(result, static_cast<double>(std::abs(a[i] - b[i])));
+    }
+    return result;
+  }
+
+}
+
+
+int main(int argc, char *argv[]) {
+  if (argc < 3) {
+    std::fprintf(stderr, "Usage: %s even.json odd.json [n_events]\n", argv[0]);
+    return 1;
+  }
+  const size_t n_events = argc > 3 ? std::atoi(argv[3]) : 1000;
+
+  using Fold = ParametricNet::Fold;
+  ParametricNet net;
+  net.init(argv[1], argv[2]);
+
+  std::ifstream input_file(argv[1]);
+  const lwt::LightweightGraph graph_even(lwt::parse_json_graph(input_file), "output_layer");
+  input_file.close();
+  input_file.open(argv[2]);
+  const lwt::LightweightGraph graph_odd(lwt::parse_json_graph(input_file), "output_layer");
+
+  std::vector<float> masses;
+  for (int mass = 251; mass <= 1000; mass += 2) {
+    masses.push_back(mass);
+  }
+  const size_t n_masses = masses.size();
+
+  // Random events in the range of the typical inputs
+  std::mt19937 rng(42);
+  std::uniform_real_distribution<double> uniform(0.0, 1000.0);
+  const std::vector<std::string> &variables = net.variables();
+  const size_t n_variables = variables.size();
+  std::vector<double> inputs(n_events * n_variables);
+  std::vector<Fold> folds(n_events);
+  for (size_t i = 0; i < n_events; ++i) {
+    std::generate_n(inputs.begin() + i * n_variables, n_variables, [&] { return uniform(rng); });
+    folds[i] = i % 2 == 0 ? Fold::Even : Fold::Odd;
+  }
+
+  // lwtnn: one graph evaluation per event and mass
+  std::vector<float> scores_lwtnn(n_events * n_masses);
+  const double t_lwtnn = time_ms([&] {
+    lwt::NodeMap nodes;
+    for (size_t i = 0; i < n_events; ++i) {
+      auto &values = nodes["input_layer"];
+      for (size_t k = 0; k < n_variables; ++k) {
+        values[variables[k]] = inputs[i * n_variables + k];
+      }
+      const lwt::LightweightGraph &graph = folds[i] == Fold::Even ? graph_odd : graph_even;
+      for (size_t j = 0; j < n_masses; ++j) {
+        values["mass"] = masses[j];
+        scores_lwtnn[i * n_masses + j] = graph.compute(nodes).at("sig_prob");
+      }
+    }
+  });
+
+  // Native: one call per event and mass
+  std::vector<float> scores_single(n_events * n_masses);
+  const double t_single = time_ms([&] {
+    for (size_t i = 0; i < n_events; ++i) {
+      net.reset();
+      for (size_t k = 0; k < n_variables; ++k) {
+        net.set_variable(k, inputs[i * n_variables + k]);
+      }
+      for (size_t j = 0; j < n_masses; ++j) {
+        scores_single[i * n_masses + j] = net.evaluate(masses[j], folds[i]);
+      }
+    }
+  });
+
+  // Native: block of events at all masses
+  std::vector<float> scores_block;
+  const double t_block = time_ms([&] {
+    net.evaluate(inputs, folds, masses, scores_block);
+  });
+
+  // Native: (event, mass) rows
+  std::vector<double> rows;
+  std::vector<Fold> row_folds;
+  for (size_t i = 0; i < n_events; ++i) {
+    for (size_t j = 0; j < n_masses; ++j) {
+      rows.insert(rows.end(), inputs.begin() + i * n_variables,
+                  inputs.begin() + (i + 1) * n_variables);
+      rows.push_back(masses[j]);
+      row_folds.push_back(folds[i]);
+    }
+  }
+  std::vector<float> scores_rows;
+  const double t_rows = time_ms([&] {
+    net.evaluate_rows(rows, row_folds, scores_rows);
+  });
+
+  const double n_scores = n_events * n_masses;
+  std::printf("%zu events x %zu masses\n", n_events, n_masses);
+  std::printf("%-20s %10s %14s %12s\n", "", "time [ms]", "scores / s", "max. diff");
+  std::printf("%-20s %10.1f %14.3g %12s\n", "lwtnn", t_lwtnn, n_scores / t_lwtnn * 1e3, "-");
+  std::printf("%-20s %10.1f %14.3g %12.3g\n", "native per mass", t_single,
+              n_scores / t_single * 1e3, max_difference(scores_lwtnn, scores_single));
+  std::printf("%-20s %10.1f %14.3g %12.3g\n", "native block", t_block,
+              n_scores / t_block * 1e3, max_difference(scores_lwtnn, scores_block));
+  std::printf("%-20s %10.1f %14.3g %12.3g\n", "native rows", t_rows,
+              n_scores / t_rows * 1e3, max_difference(scores_lwtnn, scores_rows));
+
+  return 0;
+}
@@ -0,0 +1,83 @@
+// Compares the initialisation time and the scores of a network read from the
+// lwtnn JSON files and from their binary version (scripts/compile_net.py)
+//
+// Usage: pnet_benchmark_formats even.json odd.json even.bin odd.bin [n_init] [n_events]
+
+#include <algorithm>
+#include <chrono>
+#include <cmath>
+#include <cstdio>
+#include <cstdlib>
+#include <random>
+#include <string>
+#include <vector>
+
+#include "ParametricNet/ParametricNet.h"
+
+
+namespace {
+
+  double init_time_ms(const std::string &filename_even,
+                      const std::string &filename_odd, int n_init) {
+    // Every reader is destroyed before the next one is created, so that the
+    // files are parsed again instead of taken from the shared registry
+    const auto start = std::chrono::steady_clock::now();
+    for (int i = 0; i < n_init; ++i) {
+      ParametricNet net;
+      net.init(filename_even, filename_odd);
+    }
+    const std::chrono::duration<double, std::milli> elapsed =
+      std::chrono::steady_clock::now() - start;
+    return elapsed.count() / n_init;
+  }
+
+}
+
+
+int main(int argc, char *argv[]) {
+  if (argc < 5) {
+    std::fprintf(stderr, "Usage: %s even.json odd.json even.bin odd.bin [n_init] [n_events]\n",
+                 argv[0]);
+    return 1;
+  }
+  const int n_init = argc > 5 ? std::atoi(argv[5]) : 20;
+  const int n_events = argc > 6 ? std::atoi(argv[6]) : 10000;
+
+  std::printf("Init JSON:   %8.3f ms\n", init_time_ms(argv[1], argv[2], n_init));
+  std::printf("Init binary: %8.3f ms\n", init_time_ms(argv[3], argv[4], n_init));
+
+  ParametricNet net_json, net_binary;
+  net_json.init(argv[1], argv[2]);
+  net_binary.init(argv[3], argv[4]);
+
+  std::vector<float> masses;
+  for (int mass = 251; mass <= 1000; mass += 2) {
+    masses.push_back(mass);
+  }
+
+  // Same random events for both readers
+  using Fold = ParametricNet::Fold;
+  std::mt19937 rng(42);
+  std::uniform_real_distribution<double> uniform(0.0, 1000.0);
+  const size_t n_variables = net_json.variables().size();
+  std::vector<double> inputs(n_events * n_variables);
+  std::vector<Fold> folds(n_events);
+  for (int i = 0; i < n_events; ++i) {
+    std::generate_n(inputs.begin() + i * n_variables, n_variables, [&] { return uniform(rng); });
+    folds[i] = i % 2 == 0 ? Fold::Even : Fold::Odd;
+  }
+
+  std::vector<float> scores_json, scores_binary;
+  net_json.evaluate(inputs, folds, masses, scores_json);
+  net_binary.evaluate(inputs, folds, masses, scores_binary);
+
+  double max_difference = 0.0;
+  for (size_t i = 0; i < scores_json.size(); ++i) {
+    max_difference = std::max(max_difference,
+                              static_cast<double>(std::abs(scores_json[i] - scores_binary[i])));
+  }
+  std::printf("Max. score difference (%d events x %zu masses): %g\n",
+              n_events, masses.size(), max_difference);
+
+  return max_difference > 1e-6 ? 1 : 0;
+}